@@ -1,21 +1,165 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-"""Defines the conversions laws."""
+"""Defines the conversions laws.
+
+Every law accepts either a number or an array of resistances. An array
+is converted at once and an array of temperatures is returned:
+
+>>> RuOx(1500.)
+>>> RuOx(numpy.array([1500., 2e4]))
+
+Besides the laws defined here, a calibration table can be named in the
+config file with the 'table:' prefix:
+
+law0 = table:calibrations/RX-102A.dat
+
+The table file has two columns, the resistance (Ohm) and the temperature
+(K), separated by blanks, commas or semicolons. Lines which aren't two
+numbers (headers, comments) are skipped.
+"""
+
+import bisect
+import inspect
+import math
+import os
+import re
+import numpy as np
+
+
+TABLE_PREFIX = 'table:'
+_TABLES = {}  # (path, mtime) -> CalibrationTable
 
 
 def RuOx(R):
     "Oxford RuOx thermometer."
-    import math
-    if R > 1e4:
-        return 26282.26211 * math.pow(R, -1.182087377)
-    return 0.123684 * math.exp(12018.93477 / R) + \
-        10379.105 / math.pow(R, 1.25733) - 7.89e-4
+    if np.ndim(R) == 0:
+        if R > 1e4:
+            return 26282.26211 * math.pow(R, -1.182087377)
+        return 0.123684 * math.exp(12018.93477 / R) + \
+            10379.105 / math.pow(R, 1.25733) - 7.89e-4
+    R = np.asarray(R, dtype=float)
+    T = np.empty_like(R)
+    high = R > 1e4
+    low = ~high
+    with np.errstate(all='ignore'):
+        T[high] = 26282.26211 * np.power(R[high], -1.182087377)
+        T[low] = 0.123684 * np.exp(12018.93477 / R[low]) + \
+            10379.105 / np.power(R[low], 1.25733) - 7.89e-4
+    return T
 
 
 def AB(R):
     "Oxford Allen-Bradley thermometer."
-    import math
-    return 3.60377 * math.exp(1062.013134 / R) + \
-        3532.70496 / math.pow(R, 1.07639) + 1513.7033 / R - \
-        1.369669
+    if np.ndim(R) == 0:
+        return 3.60377 * math.exp(1062.013134 / R) + \
+            3532.70496 / math.pow(R, 1.07639) + 1513.7033 / R - \
+            1.369669
+    R = np.asarray(R, dtype=float)
+    with np.errstate(all='ignore'):
+        return 3.60377 * np.exp(1062.013134 / R) + \
+            3532.70496 / np.power(R, 1.07639) + 1513.7033 / R - \
+            1.369669
+
+
+class CalibrationTable:
+    """Law interpolating a calibration table.
+
+    The interpolation is a monotone cubic (Fritsch-Carlson) of log(T)
+    versus log(R), its coefficients are computed once at loading. The
+    resistances out of the table give NaN."""
+    def __init__(self, filename):
+        self.filename = filename
+        resistances, temperatures = self.load(filename)
+        order = np.argsort(resistances)
+        x = np.log(resistances[order])
+        y = np.log(temperatures[order])
+        keep = np.concatenate(([True], np.diff(x) > 0))
+        x, y = x[keep], y[keep]
+        if len(x) < 2:
+            raise ValueError('{}: not enough points'.format(filename))
+        h = np.diff(x)
+        delta = np.diff(y) / h
+        slopes = np.empty_like(x)
+        slopes[0], slopes[-1] = delta[0], delta[-1]
+        w1 = 2 * h[1:] + h[:-1]
+        w2 = h[1:] + 2 * h[:-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inner = (w1 + w2) / (w1 / delta[:-1] + w2 / delta[1:])
+        slopes[1:-1] = np.where(delta[:-1] * delta[1:] > 0, inner, 0.)
+        # Cubic of each segment: y + c1 * dx + c2 * dx**2 + c3 * dx**3
+        self.x = x
+        self.coefs = np.array([
+            y[:-1],
+            slopes[:-1],
+            (3 * delta - 2 * slopes[:-1] - slopes[1:]) / h,
+            (slopes[:-1] + slopes[1:] - 2 * delta) / h ** 2]).T
+        self._x = x.tolist()
+        self._coefs = self.coefs.tolist()
+
+    @staticmethod
+    def load(filename):
+        "Returns the arrays (resistances, temperatures) of the file."
+        points = []
+        with open(filename) as table:
+            for line in table:
+                fields = re.split(r'[\s,;]+', line.strip())
+                try:
+                    if len(fields) == 2:
+                        points.append((float(fields[0]), float(fields[1])))
+                except ValueError:
+                    pass
+        if not points:
+            raise ValueError('{}: no calibration points'.format(filename))
+        return np.array(points).T
+
+    def __call__(self, R):
+        "Temperature of the resistance(s) 'R'."
+        if np.ndim(R) == 0:
+            if not R > 0:
+                return float('NaN')
+            x = math.log(R)
+            idx = bisect.bisect_right(self._x, x) - 1
+            if idx == len(self._x) - 1 and x == self._x[-1]:
+                idx -= 1
+            if idx < 0 or idx >= len(self._coefs):
+                return float('NaN')
+            c0, c1, c2, c3 = self._coefs[idx]
+            dx = x - self._x[idx]
+            return math.exp(c0 + dx * (c1 + dx * (c2 + dx * c3)))
+        R = np.asarray(R, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = np.log(R)
+        idx = np.searchsorted(self.x, x, side='right') - 1
+        idx[x == self.x[-1]] = len(self.x) - 2
+        outside = (idx < 0) | (idx >= len(self.coefs)) | np.isnan(x)
+        idx = np.clip(idx, 0, len(self.coefs) - 1)
+        c0, c1, c2, c3 = self.coefs[idx].T
+        dx = x - self.x[idx]
+        with np.errstate(invalid='ignore', over='ignore'):
+            T = np.exp(c0 + dx * (c1 + dx * (c2 + dx * c3)))
+        T[outside] = np.nan
+        return T
+
+
+def load_table(filename):
+    """Returns the CalibrationTable of 'filename'. A table is shared by all
+    the channels using it and loaded again only if the file changed."""
+    path = os.path.abspath(filename)
+    key = (path, os.stat(path).st_mtime)
+    if key not in _TABLES:
+        for old in [old for old in _TABLES if old[0] == path]:
+            del _TABLES[old]
+        _TABLES[key] = CalibrationTable(path)
+    return _TABLES[key]
+
+
+def get_law(name):
+    """Returns the law named 'name' in the config file: a function of this
+    module or a 'table:<file>' calibration table."""
+    if name.startswith(TABLE_PREFIX):
+        return load_table(name[len(TABLE_PREFIX):].strip())
+    law = globals().get(name)
+    if not inspect.isfunction(law) or law in (load_table, get_law):
+        raise AttributeError('Unknown conversion law {!r}'.format(name))
+    return law
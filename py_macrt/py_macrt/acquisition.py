@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Acquisition engine polling concurrently every iMACRT module.
+
+The engine runs on the event loop of the shared transport and has no GUI
+dependency:
+
+>>> acq = Acquisition({'MMR3_01': MMR3('192.168.137.100')}, period=5)
+>>> acq.start()
+>>> sample = acq.queue.get()
+
+Every channel is read with its own period, 'period' by default:
+
+>>> acq.set_modules(modules, {'MMR3_01': 60, 'MRHT_01': (0.5, 5, 5)})
+
+The deadlines of a channel are multiples of its period from the start, so
+the timing doesn't drift under load. The channels due within MERGE_WINDOW
+are read together: the resistances of every module are requested at once.
+A module which doesn't answer before the deadline, or whose replies are
+not numbers, gets NaN values and doesn't delay the others. Each poll
+produces one Sample: (time, {module_name: (R0, R1, R2)}), with None for
+the channels not read.
+"""
+
+
+import asyncio
+import collections
+import logging
+import queue
+import socket
+import time
+from . import metrics
+from .mmr3 import format_cmd
+from .transport import get_transport
+
+
+Sample = collections.namedtuple('Sample', ['time', 'values'])
+NAN = float('NaN')
+MERGE_WINDOW = 0.02  # in s, reads due within are merged in one poll
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Acquisition:
+    "Polls periodically the modules and delivers the samples."
+    def __init__(self, modules=None, period=5, callback=None,
+                 transport=None):
+        """Initialisation:
+    arguments:
+    * modules: dict {name: MMR3 or MRHT instance}
+    * period: polling period in seconds
+    * callback: called with every Sample, default to self.queue.put
+    * transport: MACRTTransport to use, default to the shared one"""
+        self.modules = dict(modules or {})
+        self.period = period
+        self.periods = {}  # name -> period or tuple of channel periods
+        self.queue = queue.Queue()
+        self.callback = callback or self.queue.put
+        self.transport = transport or get_transport()
+        self._task = None
+
+    def set_modules(self, modules, periods=None):
+        """Replace the polled modules, taken into account at the next poll.
+    'periods' is a dict {name: period or tuple of channel periods}, the
+    modules missing are read every 'period'."""
+        self.modules = dict(modules)
+        self.periods = dict(periods or {})
+
+    def channel_periods(self, name, module):
+        "Periods of the channels of the module 'name'."
+        periods = self.periods.get(name, self.period)
+        if isinstance(periods, (int, float)):
+            return tuple(periods for _ in module.channels)
+        return tuple(periods)
+
+    async def read_module(self, module, indexes=None, timeout=None):
+        """Coroutine returning the resistances of the channels 'indexes'
+    (all by default) of 'module', None for the others."""
+        if indexes is None:
+            indexes = range(len(module.channels))
+        commands = [format_cmd(module.channels[i], 'get_cmd',
+                               module.channels[i].prop_index['R'])
+                    for i in indexes]
+        timeout = min(module.timeout, timeout or self.period)
+        try:
+            replies = await self.transport.request_many(
+                (module.addr, module.port), commands, timeout)
+        except socket.timeout:
+            replies = [NAN for _ in commands]
+        try:
+            values = dict(zip(indexes, map(float, replies)))
+        except ValueError:
+            LOGGER.warning('Malformed reply from %s: %s', module.addr,
+                           replies)
+            metrics.count('acquisition_malformed_total', module=module.addr)
+            values = {i: NAN for i in indexes}
+        return tuple(values.get(i) for i in range(len(module.channels)))
+
+    async def poll(self, due=None, timeout=None):
+        """Coroutine reading the modules concurrently, returns a Sample.
+    'due' is a dict {name: channel indexes}, all the channels by default."""
+        now = time.time()
+        modules = [(name, module) for name, module in self.modules.items()
+                   if due is None or name in due]
+        with metrics.span('acquisition_poll_seconds'):
+            values = await asyncio.gather(
+                *[self.read_module(module, None if due is None
+                                   else due[name], timeout)
+                  for name, module in modules])
+        metrics.count('acquisition_samples_total')
+        return Sample(now, {name: value
+                            for (name, _), value in zip(modules, values)})
+
+    def schedule(self, deadlines, now):
+        """Channels due at 'now', given their 'deadlines' {(name, channel
+    index): date}. Returns ({name: channel indexes}, timeout of the poll,
+    next deadlines)."""
+        due = {}
+        timeout = None
+        schedule = {}
+        for name, module in self.modules.items():
+            for i, period in enumerate(self.channel_periods(name, module)):
+                deadline = deadlines.get((name, i), now)
+                # A poll must not delay the fastest channel
+                timeout = min(timeout or period, period)
+                if deadline <= now + MERGE_WINDOW:
+                    due.setdefault(name, []).append(i)
+                    deadline += period
+                    if deadline < now:
+                        # Skip the missed ticks rather than bursting
+                        deadline += (now - deadline) // period * period \
+                            + period
+                schedule[name, i] = deadline
+        return due, timeout, schedule  # Without the removed modules
+
+    async def run(self):
+        """Coroutine reading every channel at its period, without drift:
+    the reads due together are merged in one poll. A failed poll is logged
+    and the polling goes on."""
+        loop = asyncio.get_running_loop()
+        deadlines = {}  # (name, channel index) -> next deadline
+        while True:
+            delay = self.period
+            try:
+                due, timeout, deadlines = self.schedule(deadlines,
+                                                        loop.time())
+                if due:
+                    self.callback(await self.poll(due, timeout))
+                if deadlines:
+                    delay = min(deadlines.values()) - loop.time()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                LOGGER.exception('Poll failed')
+            await asyncio.sleep(max(delay, 0))
+
+    def start(self):
+        "Start the periodic polling on the transport loop."
+        if self._task is None:
+            self._task = asyncio.run_coroutine_threadsafe(
+                self.run(), self.transport.loop)
+
+    def stop(self):
+        "Stop the periodic polling."
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def trigger(self):
+        "Poll once now, out of the periodic schedule."
+        async def poll_once():
+            "Poll and deliver."
+            self.callback(await self.poll())
+        asyncio.run_coroutine_threadsafe(poll_once(), self.transport.loop)
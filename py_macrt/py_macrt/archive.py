@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Append-only binary archive of the acquired data.
+
+Alternative to the SQLite storage, for the offline analysis of long runs.
+Each channel has its own directory holding chunk files:
+
+    <root>/<module_name>/<chan_name>/00000000.bin, 00000001.bin, ...
+
+A chunk file is a header followed by fixed width records (time, R, T),
+three float64 each. The header gives the number of records written and
+the dates of the first and the last ones. The files are created at their
+full size (sparse) under a temporary name, and renamed once their header
+is written. The record count is updated after the records are written: a
+reader sees only complete records, while the acquisition keeps appending.
+
+The ArchiveWriter has the interface of storage.Writer:
+
+>>> writer = ArchiveWriter('archive')
+>>> writer.write([(time.time(), 'MMR3_01', 'Still', 1234.5, 1.2)])
+
+The readers map the files in memory and return numpy views:
+
+>>> archive = Archive('archive')
+>>> records = archive.read('MMR3_01', 'Still', t_start, t_stop)
+>>> records['t'], records['R'], records['T']
+"""
+
+
+import mmap
+import os
+import struct
+import urllib.parse
+import numpy as np
+from . import metrics
+
+
+MAGIC = b'MACRTARC'
+VERSION = 1
+# magic, version, record size, capacity, count, first time, last time
+HEADER = struct.Struct('<8sIIQQdd')
+HEADER_SIZE = 64
+RECORD = np.dtype([('t', '<f8'), ('R', '<f8'), ('T', '<f8')])
+CHUNK_RECORDS = 1 << 20  # 24 MiB per chunk file
+
+
+def channel_dir(root, module_name, chan_name):
+    "Directory of the chunk files of a channel."
+    return os.path.join(root, urllib.parse.quote(module_name, safe=''),
+                        urllib.parse.quote(chan_name, safe=''))
+
+
+def chunk_files(path):
+    "Sorted chunk files of the channel directory 'path'."
+    try:
+        names = sorted(name for name in os.listdir(path)
+                       if name.endswith('.bin'))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(path, name) for name in names]
+
+
+class ChunkWriter:
+    "Append records to the last chunk file of a channel."
+    def __init__(self, path, capacity=CHUNK_RECORDS):
+        self.path = path
+        self.capacity = capacity
+        os.makedirs(path, exist_ok=True)
+        files = chunk_files(path)
+        self.index = len(files) - 1 if files else 0
+        self.file = None
+        self.open()
+
+    def open(self):
+        "Open the current chunk file, create it if needed."
+        filename = os.path.join(self.path, '{:08d}.bin'.format(self.index))
+        if os.path.exists(filename):
+            self.file = open(filename, 'r+b')
+            (magic, version, _, self.capacity, self.count, self.t_first,
+             self.t_last) = HEADER.unpack(self.file.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('{}: not an archive chunk'.format(filename))
+        else:
+            # Built aside: the readers list only complete chunk files
+            self.file = open(filename + '.tmp', 'w+b')
+            self.count = 0
+            self.t_first = self.t_last = float('NaN')
+            self.file.truncate(HEADER_SIZE + self.capacity * RECORD.itemsize)
+            self.write_header()
+            self.file.close()
+            os.replace(filename + '.tmp', filename)
+            self.file = open(filename, 'r+b')
+
+    def write_header(self):
+        "Write the header, making the written records visible."
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.itemsize,
+                                    self.capacity, self.count, self.t_first,
+                                    self.t_last))
+        self.file.flush()
+
+    def append(self, records):
+        "Append the array of RECORD 'records'."
+        while len(records):
+            if self.count == self.capacity:
+                self.file.close()
+                self.index += 1
+                self.open()
+            part = records[:self.capacity - self.count]
+            records = records[len(part):]
+            self.file.seek(HEADER_SIZE + self.count * RECORD.itemsize)
+            self.file.write(part.tobytes())
+            self.file.flush()
+            if not self.count:
+                self.t_first = float(part['t'][0])
+            self.count += len(part)
+            self.t_last = float(part['t'][-1])
+            self.write_header()
+
+    def close(self):
+        "Close the chunk file."
+        self.file.close()
+
+
+class ArchiveWriter:
+    "Write the rows of the acquisition into the archive."
+    def __init__(self, root, capacity=CHUNK_RECORDS):
+        self.root = root
+        self.capacity = capacity
+        self.chunks = {}  # (module_name, chan_name) -> ChunkWriter
+        self.rows_written = 0
+
+    def write(self, rows):
+        """Append 'rows', each one being
+    (time, module_name, chan_name, resistance, temperature)."""
+        by_chan = {}
+        for timestamp, module_name, chan_name, resistance, temperature \
+                in rows:
+            by_chan.setdefault((module_name, chan_name), []).append(
+                (timestamp,
+                 float('NaN') if resistance is None else resistance,
+                 float('NaN') if temperature is None else temperature))
+        with metrics.span('storage_commit_seconds'):
+            for key, records in by_chan.items():
+                if key not in self.chunks:
+                    self.chunks[key] = ChunkWriter(
+                        channel_dir(self.root, *key), self.capacity)
+                self.chunks[key].append(np.array(records, dtype=RECORD))
+                self.rows_written += len(records)
+        metrics.count('storage_rows_total', len(rows))
+
+    def close(self):
+        "Close all the chunk files."
+        for chunk in self.chunks.values():
+            chunk.close()
+        self.chunks = {}
+
+
+class Chunk:
+    "Memory mapped chunk file."
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as chunk_file:
+            self.map = mmap.mmap(chunk_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        magic, version, size, self.capacity = HEADER.unpack_from(
+            self.map)[:4]
+        if magic != MAGIC or version != VERSION or size != RECORD.itemsize:
+            raise ValueError('{}: not an archive chunk'.format(filename))
+
+    def header(self):
+        "Returns (count, first time, last time), read again from the file."
+        return HEADER.unpack_from(self.map)[4:]
+
+    def records(self):
+        "View of the records written."
+        count = self.header()[0]
+        return np.frombuffer(self.map, dtype=RECORD, count=count,
+                             offset=HEADER_SIZE)
+
+
+class Archive:
+    "Read the archive."
+    def __init__(self, root):
+        self.root = root
+        self.maps = {}  # filename -> Chunk
+
+    def channels(self):
+        "List of the archived (module_name, chan_name)."
+        result = []
+        for module in sorted(os.listdir(self.root)):
+            module_path = os.path.join(self.root, module)
+            if not os.path.isdir(module_path):
+                continue
+            for chan in sorted(os.listdir(module_path)):
+                result.append((urllib.parse.unquote(module),
+                               urllib.parse.unquote(chan)))
+        return result
+
+    def chunks(self, module_name, chan_name, t_start=None, t_stop=None):
+        """Yield the views of the records between the two dates, one per
+    chunk file: no data are copied."""
+        path = channel_dir(self.root, module_name, chan_name)
+        for filename in chunk_files(path):
+            if filename not in self.maps:
+                self.maps[filename] = Chunk(filename)
+            chunk = self.maps[filename]
+            count, t_first, t_last = chunk.header()
+            if not count or (t_start is not None and t_last < t_start) or \
+                    (t_stop is not None and t_first > t_stop):
+                continue
+            records = chunk.records()
+            times = records['t']
+            start = 0 if t_start is None else int(
+                np.searchsorted(times, t_start, side='left'))
+            stop = len(times) if t_stop is None else int(
+                np.searchsorted(times, t_stop, side='right'))
+            yield records[start:stop]
+
+    def read(self, module_name, chan_name, t_start=None, t_stop=None):
+        """Records of a channel between the two dates: a view if they are
+    in one chunk file, a copy otherwise."""
+        parts = list(self.chunks(module_name, chan_name, t_start, t_stop))
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.empty(0, dtype=RECORD)
+        return np.concatenate(parts)
+
+    def close(self):
+        "Unmap the files, those still viewed are unmapped with their views."
+        for chunk in self.maps.values():
+            try:
+                chunk.map.close()
+            except BufferError:
+                pass
+        self.maps = {}
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Min/max decimation pyramid of a time series.
+
+The level 0 of a Pyramid gathers 'factor' consecutive samples per bucket,
+the level 1 'factor' buckets of the level 0, and so on. Each bucket keeps
+its first and last dates, the min, the max and the mean of its values.
+The buckets are completed as the samples are appended: the cost of an
+append is O(1) on average.
+
+A long time window is drawn from the level giving about one bucket per
+pixel: plotting the min and the max of every bucket keeps the spikes
+visible with a bounded number of points.
+"""
+
+
+import numpy as np
+
+
+FIELDS = ('t_start', 't_stop', 'min', 'max', 'sum', 'count')
+
+
+class Level:
+    "Completed buckets of one level of the pyramid."
+    def __init__(self, bucket, max_len):
+        """'bucket' is the number of raw samples per bucket, 'max_len' the
+    number of buckets kept."""
+        self.bucket = bucket
+        self.max_len = max_len
+        self._data = np.empty((2 * max_len, len(FIELDS)))
+        self.start = 0
+        self.stop = 0
+        self.partial = None  # [t_start, t_stop, min, max, sum, count, n]
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def add(self, row, n_raw):
+        """Merge 'row' into the current bucket. Returns the bucket if the
+    'n_raw' samples it now holds complete it, None otherwise."""
+        part = self.partial
+        if part is None:
+            part = self.partial = list(row) + [n_raw]
+        else:
+            part[1] = row[1]
+            if row[5]:
+                if part[5]:
+                    part[2] = min(part[2], row[2])
+                    part[3] = max(part[3], row[3])
+                else:
+                    part[2], part[3] = row[2], row[3]
+                part[4] += row[4]
+                part[5] += row[5]
+            part[6] += n_raw
+        if part[6] < self.bucket:
+            return None
+        self.partial = None
+        self.push(part[:6])
+        return part[:6]
+
+    def extend(self, rows, n_raw):
+        """Merge the consecutive 'rows', of 'n_raw' samples each. Returns
+    the array of the buckets completed."""
+        completed = []
+        k = 0
+        while self.partial is not None and k < len(rows):
+            row = self.add(rows[k], n_raw)
+            k += 1
+            if row is not None:
+                completed.append(row)
+        per_bucket = self.bucket // n_raw
+        n_buckets = (len(rows) - k) // per_bucket
+        full = rows[k:k + n_buckets * per_bucket].reshape(
+            n_buckets, per_bucket, len(FIELDS))
+        buckets = np.empty((n_buckets, len(FIELDS)))
+        buckets[:, 0] = full[:, 0, 0]
+        buckets[:, 1] = full[:, -1, 1]
+        buckets[:, 2] = np.fmin.reduce(full[:, :, 2], axis=1)  # NaN skipped
+        buckets[:, 3] = np.fmax.reduce(full[:, :, 3], axis=1)
+        buckets[:, 4] = full[:, :, 4].sum(axis=1)
+        buckets[:, 5] = full[:, :, 5].sum(axis=1)
+        self.push_many(buckets)
+        for row in rows[k + n_buckets * per_bucket:]:
+            self.add(row, n_raw)  # Too few to complete a bucket
+        return np.concatenate([np.reshape(completed, (-1, len(FIELDS))),
+                               buckets])
+
+    def push_many(self, rows):
+        "Store completed buckets, dropping the oldest if full."
+        rows = rows[len(rows) - min(len(rows), self.max_len):]
+        if self.stop + len(rows) > len(self._data):
+            kept = min(len(self), self.max_len - len(rows))
+            self._data[:kept] = self._data[self.stop - kept:self.stop]
+            self.start, self.stop = 0, kept
+        self._data[self.stop:self.stop + len(rows)] = rows
+        self.stop += len(rows)
+        self.start = max(self.start, self.stop - self.max_len)
+
+    def push(self, row):
+        "Store one completed bucket, dropping the oldest if full."
+        if self.stop == len(self._data):
+            self._data[:len(self)] = self._data[self.start:self.stop]
+            self.start, self.stop = 0, len(self)
+        self._data[self.stop] = row
+        self.stop += 1
+        if len(self) > self.max_len:
+            self.start += 1
+
+    def rows(self):
+        "View of the completed buckets, one row per bucket."
+        return self._data[self.start:self.stop]
+
+
+class Pyramid:
+    "Levels of detail of one time series."
+    def __init__(self, capacity, factor=4):
+        """'capacity' is the number of raw samples covered by the levels,
+    'factor' the number of elements merged in a bucket of the next level."""
+        self.factor = factor
+        self.levels = []
+        bucket = factor
+        while bucket <= capacity:
+            self.levels.append(Level(bucket, capacity // bucket + 1))
+            bucket *= factor
+
+    def append(self, timestamp, value):
+        "Add one raw sample."
+        if value != value:  # NaN
+            row = (timestamp, timestamp, np.nan, np.nan, 0., 0)
+        else:
+            row = (timestamp, timestamp, value, value, value, 1)
+        n_raw = 1
+        for level in self.levels:
+            row = level.add(row, n_raw)
+            if row is None:
+                break
+            n_raw = level.bucket
+
+    def extend(self, timestamps, values):
+        "Add the raw samples of the arrays 'timestamps' and 'values'."
+        valid = ~np.isnan(values)
+        rows = np.empty((len(values), len(FIELDS)))
+        rows[:, 0] = rows[:, 1] = timestamps
+        rows[:, 2] = rows[:, 3] = values
+        rows[:, 4] = np.where(valid, values, 0.)
+        rows[:, 5] = valid
+        n_raw = 1
+        for level in self.levels:
+            rows = level.extend(rows, n_raw)
+            if not len(rows):
+                break
+            n_raw = level.bucket
+
+    def level_for(self, n_samples, n_points):
+        """Returns the index of the finest level representing 'n_samples'
+    raw samples with at most 'n_points' buckets, None if the raw samples
+    fit."""
+        if n_samples <= n_points or not self.levels:
+            return None
+        for idx, level in enumerate(self.levels):
+            if n_samples <= n_points * level.bucket:
+                return idx
+        return len(self.levels) - 1
+
+    def tail(self, level_idx):
+        """Bucket of the samples not yet in a completed bucket of the level
+    'level_idx', merged from the partial buckets of the levels below. None
+    if there are none."""
+        tail = None
+        for level in self.levels[level_idx::-1]:  # Oldest samples first
+            part = level.partial
+            if part is None:
+                continue
+            if tail is None:
+                tail = part[:6]
+                continue
+            tail[1] = part[1]
+            if part[5]:
+                if tail[5]:
+                    tail[2] = min(tail[2], part[2])
+                    tail[3] = max(tail[3], part[3])
+                else:
+                    tail[2], tail[3] = part[2], part[3]
+                tail[4] += part[4]
+                tail[5] += part[5]
+        return tail
+
+    def window(self, level_idx, t_start=None, t_stop=None):
+        """Buckets of the level 'level_idx' between the two dates, ending
+    with the bucket of the newest samples (see tail)."""
+        rows = self.levels[level_idx].rows()
+        start = 0 if t_start is None else int(
+            np.searchsorted(rows[:, 1], t_start, side='left'))
+        stop = len(rows) if t_stop is None else int(
+            np.searchsorted(rows[:, 0], t_stop, side='right'))
+        rows = rows[start:stop]
+        tail = self.tail(level_idx)
+        if tail is None or (t_stop is not None and tail[0] > t_stop):
+            return rows
+        return np.concatenate([rows, [tail]])
+
+    @staticmethod
+    def envelope(rows):
+        """Returns (x, y) drawing the min and the max of each bucket:
+    the min at the bucket start and the max at its stop."""
+        x = np.empty(2 * len(rows))
+        y = np.empty(2 * len(rows))
+        x[0::2], x[1::2] = rows[:, 0], rows[:, 1]
+        y[0::2], y[1::2] = rows[:, 2], rows[:, 3]
+        return x, y
+
+    @staticmethod
+    def mean(rows):
+        "Returns (x, y) of the mean value of each bucket."
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (rows[:, 0] + rows[:, 1]) / 2, rows[:, 4] / rows[:, 5]
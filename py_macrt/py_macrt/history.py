@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Background loading of the stored data, by chunks.
+
+The time axis is cut in chunks whose span depends on the table read
+(raw samples or rollups, see storage.query). The chunks are read from
+the database by a thread and kept in a LRU cache:
+
+>>> history = History('data_storage.db')
+>>> for key in history.keys('MMR3_01', 'Still', t_start, t_stop, 60):
+...     rows = history.get(key)
+...     if rows is None:
+...         history.request(key, callback)
+
+'callback(key, rows)' is called from the loading thread.
+"""
+
+
+import collections
+import logging
+import queue
+import sqlite3
+import threading
+from . import storage
+
+
+# Span (in s) of a chunk read from the table of period (in s)
+CHUNK_SPANS = {
+    0: 3 * 3600,
+    60: 24 * 3600,
+    3600: 30 * 24 * 3600,
+    86400: 2 * 365 * 24 * 3600,
+}
+MAX_CHUNKS = 64
+CONNECT_RETRY = 1  # in s, between two checks of the schema
+
+LOGGER = logging.getLogger(__name__)
+
+
+class History(threading.Thread):
+    "Thread reading the stored data by chunks, with a LRU cache."
+    def __init__(self, filename, max_chunks=MAX_CHUNKS):
+        super(History, self).__init__(name='history.History', daemon=True)
+        self.filename = filename
+        self.max_chunks = max_chunks
+        self.cache = collections.OrderedDict()  # key -> rows
+        self.lock = threading.Lock()
+        self.requests = queue.LifoQueue()  # Last asked, first read
+        self.pending = {}  # key -> callbacks
+        self.closed = threading.Event()
+        self.start()
+
+    @staticmethod
+    def keys(module_name, chan_name, t_start, t_stop, resolution):
+        """Keys of the chunks covering the dates 't_start' to 't_stop' at
+    the 'resolution' (in s) : (module_name, chan_name, period, index)."""
+        period = max([p for p in storage.ROLLUP_PERIODS if p <= resolution],
+                     default=0)
+        span = CHUNK_SPANS[period]
+        return [(module_name, chan_name, period, index)
+                for index in range(int(t_start // span),
+                                   int(t_stop // span) + 1)]
+
+    def get(self, key):
+        "Rows of the chunk 'key' if cached, None otherwise."
+        with self.lock:
+            rows = self.cache.get(key)
+            if rows is not None:
+                self.cache.move_to_end(key)
+            return rows
+
+    def request(self, key, callback):
+        "Ask for the loading of the chunk 'key', call 'callback' when done."
+        with self.lock:
+            if key in self.pending:
+                self.pending[key].append(callback)
+                return
+            self.pending[key] = [callback]
+        self.requests.put(key)
+
+    def close(self):
+        "Stop the thread."
+        self.closed.set()
+        self.requests.put(None)
+        self.join()
+
+    def connect(self):
+        """Connection to the database, once its schema is up to date: the
+    Writer may be creating or migrating it. None if closed meanwhile."""
+        while True:
+            conn = None
+            try:
+                conn = storage.connect(self.filename, schema=False)
+                if storage.schema_version(conn) >= storage.SCHEMA_VERSION:
+                    return conn
+            except sqlite3.Error as error:  # Locked by the migration
+                LOGGER.info('Waiting for %s: %s', self.filename, error)
+            if conn is not None:
+                conn.close()
+            if self.closed.wait(CONNECT_RETRY):
+                return None
+
+    def run(self):
+        conn = self.connect()
+        if conn is None:
+            return
+        while True:
+            key = self.requests.get()
+            if key is None:
+                break
+            module_name, chan_name, period, index = key
+            span = CHUNK_SPANS[period]
+            try:
+                _, rows = storage.query(conn, module_name, chan_name,
+                                        index * span,
+                                        (index + 1) * span - 1e-3, period)
+            except sqlite3.Error:
+                LOGGER.exception('Cannot read %s', key)
+                with self.lock:
+                    self.pending.pop(key, None)
+                continue
+            with self.lock:
+                self.cache[key] = rows
+                while len(self.cache) > self.max_chunks:
+                    self.cache.popitem(last=False)
+                callbacks = self.pending.pop(key, [])
+            for callback in callbacks:
+                callback(key, rows)
+        conn.close()
@@ -0,0 +1,393 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Acquisition, conversion and storage of the iMACRT data, without GUI.
+
+The Logger is the core used by the main window. It also runs alone, as a
+daemon, from the directory holding the 'conversion' package:
+
+$ python -m py_macrt.logger config.ini
+
+It stops cleanly, saving the acquired data, on SIGINT or SIGTERM.
+
+With a 'publish' option in the [Main] section, the samples are published
+to the local subscribers (see pubsub). With a 'source' option, the Logger
+subscribes to such a publisher instead of polling the modules itself.
+"""
+
+
+import logging
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from . import metrics, scan
+from .acquisition import Acquisition
+from .mmr3 import MMR3, MRHT
+from .plan import Plan, PlanWatcher, read_config, WATCH_PERIOD
+from .pubsub import Publisher, Subscriber
+from .storage import Buffer, Writer, FLUSH_INTERVAL, FLUSH_SIZE
+from .store import SampleStore
+
+
+DATA_RETENTION = 7 * 24 * 60 * 60  # in s, samples kept in memory
+MAX_SAMPLES = 1 << 20  # Bound of the samples kept in memory
+REMOVE_AFTER = 2  # Scans missed before forgetting a module
+BACKFILL = 3600  # in s, live data asked to the source at first
+RECONNECT_PERIOD = 5  # in s, between two connections to the source
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Logger:
+    "Scan, poll, convert and store the data of the iMACRT modules."
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.config = read_config(config_file)
+        self.plan = Plan(self.config)
+        main = self.config['Main']
+
+        self.modules = {}  # name -> MMR3 or MRHT, None for a subscriber
+        period = self.plan.default_period
+        self.retention = int(main.get('data_retention', DATA_RETENTION))
+        # Sized for 'data_period': the faster channels add samples, and
+        # then the live data cover less than 'data_retention'
+        self.data = SampleStore(
+            min(max(int(self.retention // period), 1), MAX_SAMPLES))
+        self.lock = threading.Lock()  # Protects 'data' for the publisher
+        self.buffer = Buffer()
+        self.save_period = int(main.get('save_period', 30))
+        self.metrics_file = main.get('metrics_file')
+        self.source = main.get('source')
+        self.backfill = min(float(main.get('backfill', BACKFILL)),
+                            self.retention)
+        self.subscriber = None
+        self.reconnect_at = 0.  # Date of the next connection to the source
+        self.remote_channels = {}  # id -> (module_name, index, chan_name)
+        self.publisher = None
+        self.discovery = None
+        self.watcher = None
+        self.plans = queue.Queue()  # (config, plan) reloaded by the watcher
+        self.misses = {}  # name -> consecutive scans missed
+        if self.source:
+            self.acquisition = None
+            self.storage = None
+            self.writer = None
+            return
+        self.acquisition = Acquisition(period=period)
+        self.brd_addr = main.get('brd_addr', '255.255.255.255')
+        self.scan_period = float(main.get('scan_period', scan.SCAN_PERIOD))
+        self.read_cache = main.getboolean('read_cache', False)
+        self.watch_period = float(main.get('watch_period', WATCH_PERIOD))
+        if main.get('publish'):
+            self.publisher = Publisher(main['publish'], self.data, self.lock,
+                                       self.acquisition.transport.loop)
+        if main.get('save_backend', 'sqlite') == 'archive':
+            from .archive import ArchiveWriter
+            self.storage = None
+            self.writer = ArchiveWriter(main.get('archive_dir', 'archive'))
+        else:
+            self.storage = main.get('save_file', 'data_storage.db')
+            self.writer = Writer(
+                self.storage,
+                float(main.get('flush_interval', FLUSH_INTERVAL)),
+                int(main.get('flush_size', FLUSH_SIZE)),
+                float(main.get('raw_retention', 0)) or None)
+
+    def chan_name(self, name, i):
+        "Name of the channel 'i' (from 0) of the module 'name'."
+        for module_name, index, chan_name in self.remote_channels.values():
+            if (module_name, index) == (name, i):
+                return chan_name
+        return self.plan.chan_name(name, i)
+
+    def periods(self, name, module):
+        "Sampling periods of the channels of the module 'name'."
+        return self.plan.periods(name, len(module.channels))
+
+    def scan(self):
+        """Scan the subnet for active iMACRT modules, returns them. Returns
+    the modules published so far by the source, if any. The scan ends as
+    soon as the modules known or named in the config file have answered."""
+        if self.source:
+            return self.modules
+        expected = set(self.modules).union(
+            section for section in self.config.sections()
+            if section.startswith(('MMR3', 'MRHT')))
+        self.update(scan.sort(scan.scan(self.brd_addr, expected=expected)))
+        return self.modules
+
+    def update(self, found):
+        """Merge the result of a scan, a list of ('iMACRT_name', 'ip_address'),
+    into the known modules: the modules still at the same address are kept
+    as they are, those missed by REMOVE_AFTER scans are removed."""
+        found = dict(found)
+        changed = False
+        for name, addr in found.items():
+            self.misses.pop(name, None)
+            module = self.modules.get(name)
+            if module is not None and module.addr == addr:
+                continue
+            if name.startswith('MMR3'):
+                self.modules[name] = MMR3(addr)
+            elif name.startswith('MRHT'):
+                self.modules[name] = MRHT(addr)
+            else:
+                continue
+            if self.read_cache:
+                self.modules[name].enable_cache()
+            LOGGER.info('Found %s at %s', name, addr)
+            changed = True
+        for name in list(self.modules):
+            if name in found:
+                continue
+            self.misses[name] = self.misses.get(name, 0) + 1
+            if self.misses[name] >= REMOVE_AFTER:
+                LOGGER.info('Lost %s', name)
+                del self.modules[name]
+                del self.misses[name]
+                changed = True
+        if changed:
+            self.acquisition.set_modules(
+                self.modules, {name: self.periods(name, module)
+                               for name, module in self.modules.items()})
+            self.register_channels()
+
+    def register_channels(self):
+        "Declare the channels of the modules to the subscribers."
+        if self.publisher is None:
+            return
+        for name, module in self.modules.items():
+            for chan in self.plan.channels(name, len(module.channels)):
+                self.publisher.register(name, chan.index, chan.name)
+
+    def reconfigure(self):
+        "Swap in the plan compiled by the watcher, if the config changed."
+        while True:
+            try:
+                self.config, self.plan = self.plans.get_nowait()
+            except queue.Empty:
+                break
+            self.acquisition.period = self.plan.default_period
+            self.acquisition.set_modules(
+                self.modules, {name: self.periods(name, module)
+                               for name, module in self.modules.items()})
+            self.register_channels()
+
+    def rediscover(self):
+        "Merge the results of the background scans."
+        if self.discovery is None:
+            return
+        while True:
+            try:
+                self.update(self.discovery.queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def process(self, sample):
+        """Convert and record one Sample of the acquisition. Returns a list
+    of (module name, channel index, resistance, text of the conversion)."""
+        with metrics.span('logger_process_seconds'):
+            return self._process(sample)
+
+    def _process(self, sample):
+        "Convert and record one Sample, see process."
+        plan = self.plan
+        values = {}
+        results = []
+        for name, resistances in sample.values.items():
+            if name not in self.modules:
+                continue  # Removed by a scan since the poll
+            for chan, resistance in zip(plan.channels(name, len(resistances)),
+                                        resistances):
+                if resistance is None:
+                    continue  # Not sampled this time
+                converted, conv_str = chan.convert(resistance)
+                values[chan.key_R] = resistance
+                values[chan.key_T] = converted
+                self.buffer.add(sample.time, name, chan.name, resistance,
+                                converted)
+                results.append((name, chan.index, resistance, conv_str))
+        with self.lock:
+            self.data.append(sample.time, values)
+        if self.publisher is not None:
+            self.publisher.publish(sample.time, values)
+        return results
+
+    def receive(self, kind, content):
+        """Record one message of the subscriber. Returns the list of
+    (module name, channel index, resistance, text of the conversion) of the
+    last sample received."""
+        if kind == 'channels':
+            for chan_id, (module_name, index, _) in content.items():
+                for old_id, channel in list(self.remote_channels.items()):
+                    if channel[:2] == (module_name, index) and \
+                            old_id != chan_id:
+                        del self.remote_channels[old_id]  # Renamed
+                self.remote_channels[chan_id] = content[chan_id]
+                self.modules.setdefault(module_name, None)
+            return []
+        if kind == 'closed':
+            LOGGER.warning('Disconnected from %s', self.source)
+            self.subscriber.close()
+            self.subscriber = None
+            self.reconnect_at = time.monotonic() + RECONNECT_PERIOD
+            return []
+        times, channels = content
+        channels = {chan_id: values for chan_id, values in channels.items()
+                    if chan_id in self.remote_channels}
+        if self.data.count:
+            # Already received before a reconnection
+            new = times > self.data.last_time()
+            times = times[new]
+            channels = {chan_id: (resistances[new], temperatures[new])
+                        for chan_id, (resistances, temperatures)
+                        in channels.items()}
+        if not len(times):
+            return []
+        values = {}
+        for chan_id, (resistances, temperatures) in channels.items():
+            module_name, _, chan_name = self.remote_channels[chan_id]
+            values[module_name, chan_name, 'R'] = resistances
+            values[module_name, chan_name, 'T'] = temperatures
+        self.data.extend(times, values)
+        return [(self.remote_channels[chan_id][0],
+                 self.remote_channels[chan_id][1], float(resistances[-1]),
+                 self.plan.formatter.format(temperatures[-1]))
+                for chan_id, (resistances, temperatures) in channels.items()]
+
+    def subscribe(self):
+        """Connect to the source, asking for the live data missed since the
+    last sample received. Retried every RECONNECT_PERIOD on failure."""
+        backfill = self.backfill
+        if self.data.count:
+            backfill = min(backfill, time.time() - self.data.last_time())
+        try:
+            self.subscriber = Subscriber(self.source, backfill=backfill)
+        except OSError as error:
+            LOGGER.warning('Cannot connect to %s: %s', self.source, error)
+            self.reconnect_at = time.monotonic() + RECONNECT_PERIOD
+        else:
+            LOGGER.info('Connected to %s', self.source)
+
+    def start(self):
+        "Start the polling of the modules, or the subscription."
+        if self.source:
+            self.subscribe()
+        else:
+            self.acquisition.start()
+            if self.scan_period and self.discovery is None:
+                self.discovery = scan.Discovery(self.brd_addr,
+                                                self.scan_period)
+            if self.watch_period and self.watcher is None:
+                self.watcher = PlanWatcher(
+                    self.config_file, self.plan,
+                    lambda *reloaded: self.plans.put(reloaded),
+                    self.watch_period)
+            self.register_channels()
+
+    def trigger(self):
+        "Ask for an immediate reading of the modules, if polled here."
+        if self.acquisition is not None:
+            self.acquisition.trigger()
+
+    def consume(self):
+        """Process the samples waiting in the acquisition queue, or received
+    from the source (connected again if needed)."""
+        results = []
+        if self.source and self.subscriber is None and \
+                time.monotonic() >= self.reconnect_at:
+            self.subscribe()
+        while self.subscriber is not None:
+            try:
+                message = self.subscriber.queue.get_nowait()
+            except queue.Empty:
+                break
+            results.extend(self.receive(*message))
+        if self.acquisition is None:
+            return results
+        self.reconfigure()
+        self.rediscover()
+        while True:
+            try:
+                sample = self.acquisition.queue.get_nowait()
+            except queue.Empty:
+                return results
+            results.extend(self.process(sample))
+
+    def flush(self):
+        "Send the recorded data to the storage, export the metrics."
+        if self.writer is not None:
+            with metrics.span('logger_flush_seconds'):
+                self.buffer.flush(self.writer)
+        if self.metrics_file:
+            self.export_metrics(self.metrics_file)
+
+    @staticmethod
+    def export_metrics(filename):
+        "Write the snapshot of the metrics to 'filename', atomically."
+        try:
+            with open(filename + '.tmp', 'w') as metrics_file:
+                metrics_file.write(metrics.METRICS.snapshot())
+            os.replace(filename + '.tmp', filename)
+        except OSError as error:
+            LOGGER.warning('Cannot export the metrics: %s', error)
+
+    def close(self):
+        "Stop the acquisition, save the acquired data."
+        if self.subscriber is not None:
+            self.subscriber.close()
+        if self.acquisition is None:
+            return
+        if self.discovery is not None:
+            self.discovery.close()
+        if self.watcher is not None:
+            self.watcher.close()
+        self.acquisition.stop()
+        self.consume()
+        self.flush()
+        self.writer.close()
+        if self.publisher is not None:
+            self.publisher.close()
+
+    def run(self):
+        "Acquire and store until SIGINT or SIGTERM."
+        stop = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.append(True))
+        if self.source:
+            raise ValueError("The logger polls the modules, remove the "
+                             "'source' option")
+        self.scan()
+        LOGGER.info('Polling %s', ', '.join(sorted(self.modules)) or
+                    'no module')
+        if self.publisher is not None:
+            LOGGER.info('Publishing on %s', self.publisher.address)
+        self.start()
+        next_flush = time.monotonic() + self.save_period
+        while not stop:
+            try:
+                sample = self.acquisition.queue.get(timeout=0.5)
+            except queue.Empty:
+                pass
+            else:
+                self.process(sample)
+            self.reconfigure()
+            self.rediscover()
+            if time.monotonic() >= next_flush:
+                self.flush()
+                next_flush += self.save_period
+        self.close()
+        LOGGER.info('Stopped')
+
+
+def main(argv):
+    "Run the Logger with the config file given on the command line."
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    Logger(argv[1] if len(argv) > 1 else 'config.ini').run()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Counters, latency histograms and timing spans of the process.
+
+The metrics are identified by a name and labels:
+
+>>> metrics.count('macrt_timeouts_total', module='192.168.137.100')
+>>> metrics.observe('macrt_rtt_seconds', 0.002, module='192.168.137.100',
+...                 command='GET')
+>>> with metrics.span('storage_commit_seconds'):
+...     commit()
+
+The histograms have fixed buckets, so recording is a bisection and an
+increment. snapshot() exports everything in the Prometheus text format,
+summary() gives a short, human readable, view.
+"""
+
+
+import bisect
+import contextlib
+import threading
+import time
+
+
+# Upper bounds of the buckets, in s
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1, 2, 5, float('inf'))
+
+
+def format_labels(labels, **extra):
+    "Prometheus form of the labels: '{a=\"1\",b=\"2\"}'."
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value)
+                          for key, value in items) + '}'
+
+
+class Histogram:
+    "Counts of the observed values in fixed buckets."
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        "Record one value."
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def percentile(self, fraction):
+        "Upper bound of the bucket holding the 'fraction' percentile."
+        rank = fraction * self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank and total:
+                return bound
+        return float('NaN')
+
+
+class Registry:
+    "Metrics of the process, safe to update from any thread."
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+
+    def count(self, name, value=1, **labels):
+        "Add 'value' to a counter."
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        "Record 'value' in a histogram."
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        "Record the duration of the 'with' block in a histogram."
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def clear(self):
+        "Forget every metric."
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        "Text export of every metric, in the Prometheus text format."
+        lines = []
+        with self.lock:
+            name_typed = None
+            for (name, labels), value in sorted(self.counters.items()):
+                if name != name_typed:
+                    lines.append('# TYPE {} counter'.format(name))
+                    name_typed = name
+                lines.append('{}{} {}'.format(name, format_labels(labels),
+                                              value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name != name_typed:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    name_typed = name
+                total = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    total += count
+                    bound = '+Inf' if bound == float('inf') else \
+                        '{:g}'.format(bound)
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(labels, le=bound), total))
+                lines.append('{}_sum{} {!r}'.format(
+                    name, format_labels(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(
+                    name, format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        "Short text view: counters and rates, count and quantiles in ms."
+        lines = []
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('{}{}: {} ({:.2f}/s)'.format(
+                    name, format_labels(labels), value, value / elapsed))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if not histogram.count:
+                    continue
+                lines.append(
+                    '{}{}: n={} mean={:.2f} ms p50<={:g} ms p99<={:g} ms'
+                    .format(name, format_labels(labels), histogram.count,
+                            1e3 * histogram.sum / histogram.count,
+                            1e3 * histogram.percentile(0.5),
+                            1e3 * histogram.percentile(0.99)))
+        return '\n'.join(lines)
+
+
+METRICS = Registry()
+count = METRICS.count
+observe = METRICS.observe
+span = METRICS.span
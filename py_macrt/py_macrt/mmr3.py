@@ -19,10 +19,113 @@ Channels values (R, T, ...) are accessible by MMR3.chan1, .chan2, .chan3. Ex:
 >>> mmr3.chan1.R
 
 returns the measured resistance of the first channel.
+
+Several properties are read at once, with the requests sent back to back:
+>>> mmr3.read_many(['chan1.R', 'chan2.R', 'chan3.R'])
+>>> mmr3.snapshot(['R', 'X', 'range', 'status'])
+
+The values read may be cached, for 'cache_ttl' seconds per property (the
+configuration registers longer than the measurements):
+
+>>> mmr3.enable_cache({'R': 0.5})
+>>> mmr3.chan1.R, mmr3.chan1.R  # One request
+>>> mmr3.cache.stats()
+
+Setting a property forgets its cached value.
+
+Many properties are written at once, with an optional read back:
+>>> mmr3.write_many({'chan1.avg': 10, 'chan2.avg': 10}, verify=True)
+>>> write_all({('MMR3_01', 'chan1.avg'): 10, ('MRHT_01', 'period'): 80e-3},
+...           modules)
 """
 
 
+import asyncio
+import collections
+import math
 import socket
+import time
+from . import metrics
+from .transport import get_transport
+
+
+DEFAULT_TTL = 1  # in s, cache lifetime of the values measured
+CONFIG_TTL = 60  # in s, cache lifetime of the configuration registers
+VERIFY_TOLERANCE = 1e-6  # Relative difference accepted on read back
+
+# Result of the write of one property: 'ok' is True if acknowledged, or
+# read back equal if verified, 'reply' the acknowledgement, 'value' the
+# value read back, 'error' the reason of the failure.
+Written = collections.namedtuple('Written', ['ok', 'reply', 'value', 'error'])
+
+
+def same_value(written, read):
+    "Whether the value 'read' back matches the 'written' one."
+    try:
+        return math.isclose(float(written), float(read),
+                            rel_tol=VERIFY_TOLERANCE)
+    except ValueError:
+        return str(written).strip() == str(read).strip()
+
+
+class ReadCache:
+    "Values read from a module, by GET command, with their expiry date."
+    def __init__(self, ttl=None):
+        """Initialisation:
+    arguments:
+    * ttl: dict {property name: lifetime in s}, overriding the 'cache_ttl'
+      of the classes"""
+        self.ttl = dict(ttl or {})
+        self.entries = {}  # command -> (expiry date, value)
+        self.generations = {}  # command -> number of invalidations
+        self.epoch = 0  # Number of clears
+        self.hits = 0
+        self.misses = 0
+
+    def lifetime(self, obj, prop):
+        "Lifetime of the cached values of the property 'prop' of 'obj'."
+        if prop in self.ttl:
+            return self.ttl[prop]
+        return getattr(obj, 'cache_ttl', {}).get(prop, DEFAULT_TTL)
+
+    def get(self, command):
+        "Cached value of 'command', None if missing or expired."
+        entry = self.entries.get(command)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            metrics.count('macrt_cache_hits_total')
+            return entry[1]
+        self.misses += 1
+        metrics.count('macrt_cache_misses_total')
+        return None
+
+    def generation(self, command):
+        "Changes when the value read by 'command' is invalidated."
+        return self.epoch, self.generations.get(command, 0)
+
+    def put(self, command, value, ttl, generation=None):
+        """Keep the 'value' read by 'command' during 'ttl' seconds. Ignored
+    if invalidated since 'generation', taken before the read."""
+        if generation is not None and \
+                generation != self.generation(command):
+            return  # Read before a write
+        if ttl > 0:
+            self.entries[command] = (time.monotonic() + ttl, value)
+
+    def invalidate(self, command):
+        "Forget the value read by 'command', and the reads in progress."
+        self.generations[command] = self.generations.get(command, 0) + 1
+        self.entries.pop(command, None)
+
+    def clear(self):
+        "Forget every value."
+        self.epoch += 1
+        self.entries = {}
+
+    def stats(self):
+        "Returns {'hits': ..., 'misses': ..., 'entries': ...}."
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries)}
 
 
 class MACRTConn:
@@ -30,80 +133,252 @@ class MACRTConn:
     # Listen socket port: 12000
     # MMR3 port : 12000 + last IPaddr port
     # ex: 192.168.137.100 | port = 12000 + 100 = 12100
-    def __init__(self, addr, timeout=2):
+    def __init__(self, addr, timeout=2, transport=None):
         """Initialisation:
     arguments:
     * addr: ip_address of the iMACRT module
-    * timeout: close the connexion after 'timeout' seconds, default to 2"""
+    * timeout: close the connexion after 'timeout' seconds, default to 2
+    * transport: MACRTTransport to use, default to the shared one"""
         self.addr = addr
         self.port = 12000 + int(self.addr.split('.')[3])
         self.timeout = timeout
+        self._transport = transport
+        self.cache = None  # ReadCache, if enabled
 
-    def open_sock(self):
-        "Create and configure the communication socket."
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        except AttributeError:
-            # Some systems don't support SO_REUSEADDR
-            pass
-        sock.settimeout(self.timeout)
-        sock.bind(('', 12000))
-        return sock
+    def enable_cache(self, ttl=None):
+        """Cache the values read, 'ttl' is a dict {property name: lifetime
+    in s} overriding the defaults of the classes."""
+        self.cache = ReadCache(ttl)
+        return self.cache
+
+    def disable_cache(self):
+        "Read every value from the module."
+        self.cache = None
+
+    @property
+    def transport(self):
+        "Transport used to communicate, the process one if not given."
+        if self._transport is None:
+            self._transport = get_transport()
+        return self._transport
 
     def ask(self, command):
         "Send 'command' to the iMACRT, wait for the response and returns it"
-        cmd = command.encode('ascii')
-        sock = self.open_sock()
-        res = sock.sendto(cmd, (self.addr, self.port))
-        if res != len(cmd):
-            raise IOError
-        ret = sock.recv(1024)
-        sock.close()
-        return ret.decode('ascii')
+        return self.transport.ask((self.addr, self.port), command,
+                                  self.timeout)
+
+    def ask_many(self, commands):
+        """Send all the 'commands' back to back and returns the list of the
+    responses, in the same order."""
+        return self.transport.ask_many((self.addr, self.port), commands,
+                                       self.timeout)
+
+    def resolve(self, name):
+        "Returns the (object, property) designated by 'name', ex: 'chan1.R'."
+        obj = self
+        *path, prop = name.split('.')
+        for attr in path:
+            obj = getattr(obj, attr)
+        if prop not in obj.prop_index:
+            raise AttributeError(
+                '{} has no property {!r}'.format(type(obj).__name__, prop))
+        return obj, prop
+
+    def read_many(self, names):
+        """Read the properties 'names' with pipelined requests. Ex:
+
+    >>> mmr3.read_many(['temperature', 'chan1.R', 'chan2.R'])
+
+    returns a dict {name: value}. The cached values are not read again."""
+        cache = self.cache
+        values = {}
+        missing = []  # (name, command, ttl, generation)
+        for name in names:
+            obj, prop = self.resolve(name)
+            command = format_cmd(obj, 'get_cmd', obj.prop_index[prop])
+            value = None if cache is None else cache.get(command)
+            if value is not None:
+                values[name] = value
+            elif cache is None:
+                missing.append((name, command, None, None))
+            else:
+                missing.append((name, command, cache.lifetime(obj, prop),
+                                cache.generation(command)))
+        replies = self.ask_many([command for _, command, _, _ in missing]) \
+            if missing else []
+        for (name, command, ttl, generation), reply in zip(missing, replies):
+            values[name] = float(reply)
+            if cache is not None:
+                cache.put(command, values[name], ttl, generation)
+        return {name: values[name] for name in names}
+
+    async def request_write_many(self, values, verify=False):
+        """Coroutine writing the properties of 'values', see write_many."""
+        results = {}
+        items = []  # (name, object, property index, value)
+        for name, value in values.items():
+            try:
+                obj, prop = self.resolve(name)
+                if getattr(type(obj), prop).fset is None:
+                    raise AttributeError('{!r} is read only'.format(name))
+            except AttributeError as error:
+                results[name] = Written(False, None, None, str(error))
+                continue
+            items.append((name, obj, obj.prop_index[prop], value))
+        addr = (self.addr, self.port)
+        try:
+            replies = await self.transport.request_each(
+                addr, [format_cmd(obj, 'set_cmd', idx, value)
+                       for _, obj, idx, value in items], self.timeout)
+        except socket.timeout:  # Circuit open
+            replies = [None for _ in items]
+        gets = [format_cmd(obj, 'get_cmd', idx) for _, obj, idx, _ in items]
+        if self.cache is not None:
+            for command in gets:
+                self.cache.invalidate(command)
+        readbacks = [None for _ in items]
+        if verify and items:
+            # Read back even the unacknowledged writes: the acknowledgement
+            # may be lost while the value was written
+            try:
+                readbacks = await self.transport.request_each(
+                    addr, gets, self.timeout)
+            except socket.timeout:
+                pass
+        for (name, _, _, value), reply, readback in zip(items, replies,
+                                                        readbacks):
+            if not verify and reply is None:
+                results[name] = Written(False, None, None,
+                                        'No acknowledgement')
+            elif not verify:
+                results[name] = Written(True, reply, None, None)
+            elif readback is None:
+                results[name] = Written(False, reply, None, 'No read back')
+            elif same_value(value, readback):
+                results[name] = Written(True, reply, readback, None)
+            else:
+                results[name] = Written(False, reply, readback,
+                                        'Read back {}'.format(readback))
+        return {name: results[name] for name in values}
+
+    def write_many(self, values, verify=False):
+        """Write the properties of 'values', a dict {name: value}, with
+    pipelined requests. Ex:
+
+    >>> mmr3.write_many({'period': 80e-3, 'chan1.avg': 10}, verify=True)
+
+    If 'verify', the properties are read back, in one pipelined pass too.
+    Returns a dict {name: Written}."""
+        return self.transport.call(self.request_write_many(values, verify))
+
+    def snapshot(self, chan_props=None):
+        """Read every module property and the 'chan_props' properties of
+    every channel (all of them by default) in one pipelined pass.
+    Returns a dict: {'time': ..., 'period': ..., 'chan1': {'R': ...}, ...}"""
+        names = list(self.prop_index)
+        for i, chan in enumerate(self.channels, 1):
+            props = chan.prop_index if chan_props is None else [
+                prop for prop in chan_props if prop in chan.prop_index]
+            names.extend('chan{}.{}'.format(i, prop) for prop in props)
+        now = time.time()
+        values = self.read_many(names)
+        record = {'time': now}
+        for name, value in values.items():
+            *path, prop = name.split('.')
+            node = record
+            for attr in path:
+                node = node.setdefault(attr, {})
+            node[prop] = value
+        return record
+
+
+def write_all(values, modules, verify=False):
+    """Write properties of many modules concurrently: 'values' is a dict
+    {(module name, property name): value}, 'modules' a dict
+    {module name: MMR3 or MRHT}. Returns a dict {(module name, property
+    name): Written}, see MACRTConn.write_many."""
+    by_module = {}
+    results = {}
+    for (module_name, name), value in values.items():
+        if module_name in modules:
+            by_module.setdefault(module_name, {})[name] = value
+        else:
+            results[module_name, name] = Written(False, None, None,
+                                                 'Unknown module')
+    if by_module:
+        async def write():
+            "Write to all the modules at once."
+            return await asyncio.gather(
+                *[modules[module_name].request_write_many(module_values,
+                                                          verify)
+                  for module_name, module_values in by_module.items()])
+        transport = modules[next(iter(by_module))].transport
+        for module_name, written in zip(by_module, transport.call(write())):
+            for name, result in written.items():
+                results[module_name, name] = result
+    return {key: results[key] for key in values}
+
+
+def format_cmd(obj, template, prop_idx, value=None):
+    "Format the 'template' command string of the property 'prop_idx'."
+    cmd = getattr(obj, template, "")
+    chan_idx = getattr(obj, 'chan_idx', 0)
+    idx_offset = getattr(obj, 'idx_offset', 0)
+    idx_sum = prop_idx + idx_offset
+    return cmd.format(chan_idx=chan_idx, idx_offset=idx_offset,
+                      idx_sum=idx_sum, value=value)
 
 
 class MACRTMeta(type):
     "Meta-class creates the class properties"
     def __new__(mcs, name, bases, dct):
         "Called for the class creation."
-        def __get_cmd(prop_idx):
+        def __get_cmd(prop_idx, prop):
             "Common function to get attributes from the iMACRT module."
             def func(obj):
                 "Format the 'get_cmd' string"
-                get_cmd = getattr(obj, 'get_cmd', "")
-                chan_idx = getattr(obj, 'chan_idx', 0)
-                idx_offset = getattr(obj, 'idx_offset', 0)
-                idx_sum = prop_idx + idx_offset
-                cmd = get_cmd.format(**locals())
-                return float(obj.ask(cmd))
+                command = format_cmd(obj, 'get_cmd', prop_idx)
+                cache = getattr(obj, 'parent', obj).cache
+                if cache is None:
+                    return float(obj.ask(command))
+                value = cache.get(command)
+                if value is None:
+                    generation = cache.generation(command)
+                    value = float(obj.ask(command))
+                    cache.put(command, value, cache.lifetime(obj, prop),
+                              generation)
+                return value
             return func
 
         def __set_cmd(prop_idx):
             "Common function to set attributes to the iMACRT module."
             def func(obj, value):
                 "Format the 'set_cmd' string"
-                set_cmd = getattr(obj, 'set_cmd', "")
-                chan_idx = getattr(obj, 'chan_idx', 0)
-                idx_offset = getattr(obj, 'idx_offset', 0)
-                chan_idx = getattr(obj, 'chan_idx', 0)
-                idx_sum = prop_idx + idx_offset
-                cmd = set_cmd.format(**locals())
-                return obj.ask(cmd)
+                try:
+                    return obj.ask(format_cmd(obj, 'set_cmd', prop_idx,
+                                              value))
+                finally:
+                    # Once acknowledged: a GET sent before is answered
+                    # with the former value, not to be kept
+                    cache = getattr(obj, 'parent', obj).cache
+                    if cache is not None:
+                        cache.invalidate(format_cmd(obj, 'get_cmd',
+                                                    prop_idx))
             return func
 
         cls = super(MACRTMeta, mcs).__new__(mcs, name, bases, dct)
         properties = dct.get('properties', [])
+        cls.prop_index = {name: idx
+                          for idx, (name, writable) in enumerate(properties)}
 
         for idx, (name, writable) in enumerate(properties):
             if writable:
                 prop = property(
-                    __get_cmd(idx),
+                    __get_cmd(idx, name),
                     __set_cmd(idx),
                     None)
             else:
-                prop = property(__get_cmd(idx), None, None)
+                prop = property(__get_cmd(idx, name), None, None)
             setattr(cls, name, prop)
         return cls
 
@@ -113,12 +388,15 @@ class MMR3(MACRTConn, metaclass=MACRTMeta):
     get_cmd = 'MMR3GET {idx_sum}'
     set_cmd = 'MMR3SET {idx_sum} {value}'
     properties = (('period', True), ('DtADC', True), ('temperature', False))
+    cache_ttl = {'period': CONFIG_TTL, 'DtADC': CONFIG_TTL}
 
     def __init__(self, *args, **kwargs):
         super(MMR3, self).__init__(*args, **kwargs)
+        self.channels = []
         for i in range(1, 4):
-            setattr(self, 'chan' + str(i),
-                    MMR3Chan(self, i, 3 + (i - 1) * 11))
+            chan = MMR3Chan(self, i, 3 + (i - 1) * 11)
+            setattr(self, 'chan' + str(i), chan)
+            self.channels.append(chan)
 
 
 class MMR3Chan(metaclass=MACRTMeta):
@@ -127,8 +405,11 @@ class MMR3Chan(metaclass=MACRTMeta):
                   ('status', False), ('avg', True), ('range_mode', True),
                   ('range_mode_I', True), ('range_I', True), ('range_U', True),
                   ('I', True), ('offset', False))
+    cache_ttl = {name: CONFIG_TTL for name in (
+        'avg', 'range_mode', 'range_mode_I', 'range_I', 'range_U', 'I')}
 
     def __init__(self, parent, chan_idx=0, idx_offset=0):
+        self.parent = parent
         self.ask = parent.ask
         self.get_cmd = parent.get_cmd
         self.set_cmd = parent.set_cmd
@@ -141,12 +422,15 @@ class MRHT(MACRTConn, metaclass=MACRTMeta):
     get_cmd = 'MRHTGET {idx_sum}'
     set_cmd = 'MRHTSET {idx_sum} {value}'
     properties = (('period', True), ('DtADC', True), ('temperature', False))
+    cache_ttl = {'period': CONFIG_TTL, 'DtADC': CONFIG_TTL}
 
     def __init__(self, *args, **kwargs):
         super(MRHT, self).__init__(*args, **kwargs)
+        self.channels = []
         for i in range(1, 4):
-            setattr(self, 'chan' + str(i),
-                    MRHTChan(self, i, 256 * i + 1))
+            chan = MRHTChan(self, i, 256 * i + 1)
+            setattr(self, 'chan' + str(i), chan)
+            self.channels.append(chan)
 
 
 class MRHTChan(metaclass=MACRTMeta):
@@ -157,8 +441,11 @@ class MRHTChan(metaclass=MACRTMeta):
                   ('Mode', True), ('ModeI', True),
                   ('range_I', True), ('range_U', True),
                   ('modul', True), ('power', False))
+    cache_ttl = {name: CONFIG_TTL for name in (
+        'I_set', 'Mode', 'ModeI', 'range_I', 'range_U', 'modul')}
 
     def __init__(self, parent, chan_idx=0, idx_offset=0):
+        self.parent = parent
         self.ask = parent.ask
         self.get_cmd = parent.get_cmd
         self.set_cmd = parent.set_cmd
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Acquisition plan compiled from the config file.
+
+The names, conversion laws, formatter and sampling periods of the channels
+are resolved once, when the config file is read:
+
+>>> plan = Plan(config)
+>>> for chan, resistance in zip(plan.channels('MMR3_01', 3), resistances):
+...     temperature, text = chan.convert(resistance)
+
+A plan is not modified once compiled, except to add the channels of the
+modules found later. The PlanWatcher thread compiles a new one when the
+config file, or a calibration table it uses, changes; the user of the plan
+swaps it in one assignment.
+"""
+
+
+import logging
+import os
+import threading
+from configparser import ConfigParser, Error as ConfigError
+import conversion
+
+
+WATCH_PERIOD = 1  # in s, between two checks of the config file
+NAN = float('NaN')
+
+LOGGER = logging.getLogger(__name__)
+
+
+def read_config(config_file):
+    "ConfigParser of 'config_file', with a [Main] section."
+    config = ConfigParser()
+    try:
+        config.read(config_file)
+    except AttributeError:
+        pass
+    if not config.has_section('Main'):
+        config.add_section('Main')
+    return config
+
+
+def read_period(section, option, default):
+    "Period in s given by 'option' of 'section', ValueError if not > 0."
+    period = float(section.get(option, default))
+    if not period > 0:
+        raise ValueError('{} = {} in [{}]: a period must be positive'.format(
+            option, period, section.name))
+    return period
+
+
+class ChannelPlan:
+    "Name, keys and conversion law of one channel."
+    __slots__ = ('index', 'name', 'key_R', 'key_T', 'law_name', 'law',
+                 'error', 'format')
+
+    def __init__(self, module_name, index, name, law_name, law, error,
+                 formatter):
+        self.index = index
+        self.name = name
+        self.key_R = (module_name, name, 'R')
+        self.key_T = (module_name, name, 'T')
+        self.law_name = law_name
+        self.law = law
+        self.error = error  # Text displayed if the law is missing
+        self.format = formatter.format
+
+    def convert(self, resistance):
+        "Returns (temperature, text to display)."
+        if self.law is None:
+            return NAN, self.error
+        try:
+            converted = self.law(resistance)
+        except ZeroDivisionError:
+            return NAN, 'ZeroDivision with law {}.'.format(self.law_name)
+        except (OverflowError, ValueError):
+            return NAN, 'Out of the range of law {}.'.format(self.law_name)
+        return converted, self.format(converted)
+
+
+class Plan:
+    "Channels and periods of every module, compiled from a ConfigParser."
+    def __init__(self, config):
+        self.config = config
+        self.default_period = read_period(config['Main'], 'data_period', 5)
+        self.formatter = config['Main'].get('formatter', '{:.4f}')
+        self.files = {}  # filename -> mtime, of the calibration tables
+        self._channels = {}  # (module_name, n_channels) -> ChannelPlans
+        # Rejected now rather than when the module is found
+        for section in config.values():
+            for option in section:
+                suffix = option[len('period'):]
+                if option.startswith('period') and \
+                        (not suffix or suffix.isdigit()):
+                    read_period(section, option, None)
+
+    def law(self, module_name, i):
+        "Returns (law name, law, error) of the channel 'i' of a module."
+        law_name = None
+        try:
+            law_name = self.config[module_name]['Law' + str(i)]
+            law = conversion.get_law(law_name)
+        except (KeyError, AttributeError):
+            return law_name, None, "Wrong or missing configuration file."
+        except (OSError, ValueError) as error:
+            return law_name, None, 'Cannot load law {}: {}.'.format(
+                law_name, error)
+        if law_name.startswith(conversion.TABLE_PREFIX):
+            filename = law_name[len(conversion.TABLE_PREFIX):].strip()
+            self.files[filename] = os.stat(filename).st_mtime
+        return law_name, law, None
+
+    def chan_name(self, module_name, i):
+        "Name of the channel 'i' (from 0) of the module 'module_name'."
+        default = 'Chan' + str(i)
+        if not self.config.has_section(module_name):
+            return default
+        return self.config[module_name].get('Chan' + str(i), default)
+
+    def channels(self, module_name, n_channels=3):
+        "Tuple of the ChannelPlan of the channels of a module."
+        key = (module_name, n_channels)
+        channels = self._channels.get(key)
+        if channels is None:
+            channels = self._channels[key] = tuple(
+                ChannelPlan(module_name, i, self.chan_name(module_name, i),
+                            *self.law(module_name, i), self.formatter)
+                for i in range(n_channels))
+        return channels
+
+    def periods(self, module_name, n_channels=3):
+        """Sampling periods of the channels of a module: options 'Period0',
+    'Period1'... or 'Period' of its section, 'default_period' otherwise."""
+        if not self.config.has_section(module_name):
+            return self.default_period
+        section = self.config[module_name]
+        period = read_period(section, 'Period', self.default_period)
+        return tuple(read_period(section, 'Period' + str(i), period)
+                     for i in range(n_channels))
+
+    def reload(self, config):
+        "New Plan of 'config', with the channels of this one compiled."
+        plan = Plan(config)
+        for module_name, n_channels in list(self._channels):
+            plan.channels(module_name, n_channels)
+        return plan
+
+
+class PlanWatcher(threading.Thread):
+    """Compile a new Plan when the config file or a calibration table
+    changes, and give it to 'callback(config, plan)'."""
+    def __init__(self, config_file, plan, callback, period=WATCH_PERIOD):
+        super(PlanWatcher, self).__init__(name='plan.PlanWatcher',
+                                          daemon=True)
+        self.config_file = config_file
+        self.plan = plan
+        self.callback = callback
+        self.period = period
+        self.mtime = self.stat(config_file)
+        self.stopped = threading.Event()
+        self.start()
+
+    @staticmethod
+    def stat(filename):
+        "Modification date of 'filename', None if missing."
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def changed(self):
+        "Whether the config file or a table used changed since compiled."
+        if self.stat(self.config_file) != self.mtime:
+            return True
+        return any(self.stat(filename) != mtime
+                   for filename, mtime in list(self.plan.files.items()))
+
+    def run(self):
+        while not self.stopped.wait(self.period):
+            if not self.changed():
+                continue
+            self.mtime = self.stat(self.config_file)
+            try:
+                config = read_config(self.config_file)
+                plan = self.plan.reload(config)
+            except (ConfigError, ValueError) as error:
+                LOGGER.warning('Config file not reloaded: %s', error)
+                continue
+            self.plan = plan
+            LOGGER.info('Config file reloaded')
+            self.callback(config, plan)
+
+    def close(self):
+        "Stop watching."
+        self.stopped.set()
+        self.join()
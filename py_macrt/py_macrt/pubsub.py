@@ -0,0 +1,337 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Publish the live samples to local subscribers.
+
+The process polling the modules publishes its samples on a TCP or Unix
+socket endpoint ('publish' option of the [Main] section):
+
+    publish = tcp:127.0.0.1:8765
+    publish = unix:/run/py_macrt.sock
+
+Any number of clients subscribe to some channels (all by default), get
+the last 'backfill' seconds of the live buffer, then every new sample.
+The clients subscribed to all the channels are told of the channels added
+later (new modules, renamed channels):
+
+>>> subscriber = Subscriber('tcp:127.0.0.1:8765', [('MMR3_01', 'Still')],
+...                         backfill=600)
+>>> kind, content = subscriber.queue.get()
+
+A main window whose [Main] section has a 'source' option displays the
+samples of such an endpoint instead of polling the modules.
+
+Framing: every frame is a header (type: uint8, payload size: uint32)
+followed by the payload, little endian.
+* SUBSCRIBE, client -> server: backfill in s (float64), number of
+  channels (uint16), channel names. None for all the channels.
+* CHANNELS, server -> client: number of channels (uint16), then for each
+  one its id (uint16), its index in the module (uint8) and its name.
+* SAMPLES, server -> client: number of samples n (uint32), number of
+  channels c (uint16), the c channel ids (uint16), the n times (float64),
+  then for each channel its n resistances and n temperatures (float64).
+A name is its size (uint16) and 'module_name\\0chan_name' in UTF-8.
+"""
+
+
+import asyncio
+import logging
+import queue
+import socket
+import struct
+import threading
+import numpy as np
+
+
+SUBSCRIBE, CHANNELS, SAMPLES = 1, 2, 3
+HEADER = struct.Struct('<BI')
+MAX_BUFFER = 16 * 1024 * 1024  # Pending bytes before dropping a client
+BACKFILL_FRAME = 4096  # Samples per SAMPLES frame of a backfill
+
+LOGGER = logging.getLogger(__name__)
+
+
+def parse_address(address):
+    "'tcp:host:port' -> ('tcp', (host, port)), 'unix:path' -> ('unix', path)"
+    kind, _, rest = address.partition(':')
+    if kind == 'tcp':
+        host, _, port = rest.rpartition(':')
+        return kind, (host or '127.0.0.1', int(port))
+    if kind == 'unix':
+        return kind, rest
+    raise ValueError('Unknown address {!r}'.format(address))
+
+
+def pack_name(module_name, chan_name):
+    "Encode a channel name."
+    name = '{}\0{}'.format(module_name, chan_name).encode('utf-8')
+    return struct.pack('<H', len(name)) + name
+
+
+def unpack_name(payload, offset):
+    "Decode a channel name, returns ((module_name, chan_name), offset)."
+    size, = struct.unpack_from('<H', payload, offset)
+    offset += 2
+    module_name, chan_name = payload[offset:offset + size].decode(
+        'utf-8').split('\0')
+    return (module_name, chan_name), offset + size
+
+
+def frame(kind, payload):
+    "Header and payload of a frame."
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def pack_channels(channels):
+    "CHANNELS payload of 'channels', {(module_name, chan_name): (id, index)}."
+    return struct.pack('<H', len(channels)) + b''.join(
+        struct.pack('<HB', chan_id, index) + pack_name(*key)
+        for key, (chan_id, index) in channels.items())
+
+
+def pack_samples(ids, times, resistances, temperatures):
+    """SAMPLES payload: 'times' is an array of n dates, 'resistances' and
+    'temperatures' lists of arrays of n values, one per channel of 'ids'."""
+    parts = [struct.pack('<IH', len(times), len(ids)),
+             struct.pack('<{}H'.format(len(ids)), *ids),
+             np.asarray(times, dtype='<f8').tobytes()]
+    for resistance, temperature in zip(resistances, temperatures):
+        parts.append(np.asarray(resistance, dtype='<f8').tobytes())
+        parts.append(np.asarray(temperature, dtype='<f8').tobytes())
+    return b''.join(parts)
+
+
+def unpack_samples(payload):
+    "Returns (times, {channel id: (resistances, temperatures)})."
+    n_samples, n_channels = struct.unpack_from('<IH', payload)
+    offset = 6
+    ids = struct.unpack_from('<{}H'.format(n_channels), payload, offset)
+    offset += 2 * n_channels
+    arrays = np.frombuffer(payload, dtype='<f8', offset=offset).reshape(
+        2 * n_channels + 1, n_samples)
+    return arrays[0], {chan_id: (arrays[1 + 2 * k], arrays[2 + 2 * k])
+                       for k, chan_id in enumerate(ids)}
+
+
+class Publisher:
+    "Server pushing the samples of a SampleStore to the subscribers."
+    def __init__(self, address, store, lock, loop):
+        """Initialisation:
+    arguments:
+    * address: 'tcp:host:port' or 'unix:path'
+    * store: SampleStore of the live data, for the backfills
+    * lock: lock protecting the store
+    * loop: asyncio event loop (running in another thread) of the server"""
+        self.address = address
+        self.store = store
+        self.lock = lock
+        self.loop = loop
+        self.channels = {}  # (module_name, chan_name) -> (id, index)
+        self.clients = {}  # StreamWriter -> (names asked, set of ids)
+        self.server = asyncio.run_coroutine_threadsafe(
+            self._start(), loop).result()
+
+    async def _start(self):
+        "Open the server socket."
+        kind, addr = parse_address(self.address)
+        if kind == 'tcp':
+            return await asyncio.start_server(self._serve, *addr)
+        return await asyncio.start_unix_server(self._serve, addr)
+
+    def register(self, module_name, index, chan_name):
+        """Declare the channel 'index' of a module, returns its id. The
+    subscribers of all the channels are told of a new one."""
+        key = (module_name, chan_name)
+        if key not in self.channels:
+            # Replaced, not modified: the loop may be iterating over it
+            channels = dict(self.channels)
+            channels[key] = (len(channels), index)
+            self.channels = channels
+            self.loop.call_soon_threadsafe(self._announce, key)
+        return self.channels[key][0]
+
+    def publish(self, timestamp, values):
+        """Send one sample to the subscribers: 'values' is the dict given to
+    SampleStore.append. Thread safe."""
+        self.loop.call_soon_threadsafe(self._publish, timestamp, values)
+
+    def close(self):
+        "Disconnect the clients and close the server."
+        async def stop():
+            "Close on the loop."
+            self.server.close()
+            for writer in list(self.clients):
+                writer.close()
+            self.clients = {}
+        asyncio.run_coroutine_threadsafe(stop(), self.loop).result()
+
+    def _announce(self, key):
+        "Send the new channel 'key' to the clients asking for it."
+        chan_id, index = self.channels[key]
+        for writer, (names, ids) in list(self.clients.items()):
+            if (not names or key in names) and chan_id not in ids:
+                ids.add(chan_id)
+                self._send(writer, frame(CHANNELS, pack_channels(
+                    {key: (chan_id, index)})))
+
+    def _publish(self, timestamp, values):
+        "Send one sample, from the loop."
+        for writer, (_, ids) in list(self.clients.items()):
+            sent = [(chan_id, key) for key, (chan_id, _) in
+                    self.channels.items() if chan_id in ids
+                    and key + ('R', ) in values]
+            if not sent:
+                continue
+            payload = pack_samples(
+                [chan_id for chan_id, _ in sent], [timestamp],
+                [[values[key + ('R', )]] for _, key in sent],
+                [[values[key + ('T', )]] for _, key in sent])
+            self._send(writer, frame(SAMPLES, payload))
+
+    def _send(self, writer, data):
+        "Write 'data' to a client, drop it if it doesn't keep up."
+        if writer.transport.get_write_buffer_size() > MAX_BUFFER:
+            LOGGER.warning('Dropping a slow subscriber')
+            self.clients.pop(writer, None)
+            writer.close()
+            return
+        writer.write(data)
+
+    async def _serve(self, reader, writer):
+        "Handle one subscriber."
+        try:
+            kind, size = HEADER.unpack(
+                await reader.readexactly(HEADER.size))
+            payload = await reader.readexactly(size)
+            if kind != SUBSCRIBE:
+                raise ValueError('SUBSCRIBE expected')
+            backfill, count = struct.unpack_from('<dH', payload)
+            offset = 10
+            names = []
+            for _ in range(count):
+                name, offset = unpack_name(payload, offset)
+                names.append(name)
+            channels = {key: value for key, value in self.channels.items()
+                        if not names or key in names}
+            writer.write(frame(CHANNELS, pack_channels(channels)))
+            t_start = -float('inf')
+            while backfill > 0 and channels:
+                payloads, t_start = self._backfill(channels, backfill,
+                                                   t_start)
+                if not payloads:
+                    break
+                for payload in payloads:
+                    writer.write(frame(SAMPLES, payload))
+                    await writer.drain()
+            # Caught up with the store: registered without waiting, the
+            # client gets the next samples in order
+            ids = {chan_id for chan_id, _ in channels.values()}
+            added = {key: value for key, value in self.channels.items()
+                     if (not names or key in names) and value[0] not in ids}
+            if added:
+                ids.update(chan_id for chan_id, _ in added.values())
+                writer.write(frame(CHANNELS, pack_channels(added)))
+            self.clients[writer] = (names, ids)
+            await writer.drain()
+            while await reader.read(1024):
+                pass  # Nothing more expected, wait for the disconnection
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError,
+                struct.error) as error:
+            LOGGER.info('Subscriber disconnected: %s', error)
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    def _backfill(self, channels, backfill, t_start):
+        """SAMPLES payloads, of BACKFILL_FRAME samples at most, of the last
+    'backfill' seconds of 'channels' taken after 't_start'. Returns
+    (payloads, date of the last sample)."""
+        with self.lock:
+            keys = [key for key in channels if key + ('R', ) in self.store]
+            if not self.store.count or not keys:
+                return [], t_start
+            times = self.store.times()
+            start = max(self.store.index(self.store.last_time() - backfill),
+                        int(np.searchsorted(times, t_start, side='right')))
+            times = times[start:].copy()
+            resistances = [self.store.column(key + ('R', ))[start:].copy()
+                           for key in keys]
+            temperatures = [self.store.column(key + ('T', ))[start:].copy()
+                            for key in keys]
+        if not len(times):
+            return [], t_start
+        ids = [channels[key][0] for key in keys]
+        return [pack_samples(ids, times[start:start + BACKFILL_FRAME],
+                             [values[start:start + BACKFILL_FRAME]
+                              for values in resistances],
+                             [values[start:start + BACKFILL_FRAME]
+                              for values in temperatures])
+                for start in range(0, len(times), BACKFILL_FRAME)], times[-1]
+
+
+class Subscriber(threading.Thread):
+    """Client of a Publisher. The received messages are put in 'queue':
+    ('channels', {id: (module_name, index, chan_name)}), with the channels
+    added later too, ('samples', (times, {id: (resistances, temperatures)}))
+    and ('closed', None) at the end of the subscription. The last sample
+    of the backfill may be received again, live."""
+    def __init__(self, address, channels=None, backfill=0):
+        """Initialisation:
+    arguments:
+    * address: 'tcp:host:port' or 'unix:path' of the Publisher
+    * channels: list of (module_name, chan_name), None for all
+    * backfill: seconds of live data to get at first"""
+        super(Subscriber, self).__init__(name='pubsub.Subscriber',
+                                         daemon=True)
+        self.address = address
+        self.channels = list(channels or [])
+        self.backfill = backfill
+        self.queue = queue.Queue()
+        kind, addr = parse_address(address)
+        family = socket.AF_INET if kind == 'tcp' else socket.AF_UNIX
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(addr)
+        self.sock.sendall(frame(SUBSCRIBE, struct.pack(
+            '<dH', backfill, len(self.channels)) + b''.join(
+                pack_name(*key) for key in self.channels)))
+        self.start()
+
+    def recv(self, size):
+        "Receive exactly 'size' bytes."
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('Publisher disconnected')
+            data += chunk
+        return bytes(data)
+
+    def run(self):
+        try:
+            while True:
+                kind, size = HEADER.unpack(self.recv(HEADER.size))
+                payload = self.recv(size)
+                if kind == CHANNELS:
+                    count, = struct.unpack_from('<H', payload)
+                    offset = 2
+                    channels = {}
+                    for _ in range(count):
+                        chan_id, index = struct.unpack_from('<HB', payload,
+                                                            offset)
+                        (module_name, chan_name), offset = unpack_name(
+                            payload, offset + 3)
+                        channels[chan_id] = (module_name, index, chan_name)
+                    self.queue.put(('channels', channels))
+                elif kind == SAMPLES:
+                    self.queue.put(('samples', unpack_samples(payload)))
+        except (ConnectionError, OSError) as error:
+            LOGGER.info('Subscription ended: %s', error)
+            self.queue.put(('closed', None))
+
+    def close(self):
+        "End the subscription."
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.join()
@@ -1,44 +1,100 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-"Scan the subnet for active iMACRT modules."
+"""Scan the subnet for active iMACRT modules.
 
+>>> sort(scan('192.168.137.255', expected=['MMR3_01_2_073_v2.2']))
 
+returns as soon as every expected module has answered. The Discovery
+thread scans periodically in the background:
+
+>>> discovery = Discovery('192.168.137.255', period=60)
+>>> modules = discovery.queue.get()
+"""
+
+
+import queue
 import socket
 import select
+import threading
+import time
+
+
+SCAN_PERIOD = 60  # in s, between two background scans
+_SCAN_LOCK = threading.Lock()  # One scan at a time listens on port 8001
+
 
+def module_name(data):
+    "Name of the module from its reply to the scan."
+    return data.decode('ascii').split('\x00')[0].split(' ')[-1]
 
-def scan(brd_addr='<broadcast>', timeout=2):
+
+def scan(brd_addr='<broadcast>', timeout=2, expected=None):
     """Scan for responding iMACRT modules.
     Will use the broadcast address 'brd_addr' for scanning.
 
-    Send the datagram "0 1" to 8001 port."""
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    try:
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-    except AttributeError:
-        # Some systems don't support SO_REUSEPORT
-        pass
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    sock.setblocking(False)
-
-    sock.bind(('0.0.0.0', 8001))
-    sock.sendto(b"0 1", (brd_addr, 8001))
-    response = []
-    while True:
-        readables, writable, excp = select.select([sock, ], [], [], timeout)
-        if not readables:
-            # Timeout
-            break
-        for readable in readables:
-            data, sender_addr = readable.recvfrom(1024)
-            if data != b'0 1':
-                response.append((data, sender_addr))
+    Send the datagram "0 1" to 8001 port. Wait for the replies during
+    'timeout' seconds, or until all the modules named in 'expected' have
+    answered."""
+    expected = set(expected or [])
+    with _SCAN_LOCK:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        except AttributeError:
+            # Some systems don't support SO_REUSEPORT
+            pass
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setblocking(False)
+
+        sock.bind(('0.0.0.0', 8001))
+        sock.sendto(b"0 1", (brd_addr, 8001))
+        deadline = time.monotonic() + timeout
+        response = []
+        answered = set()
+        while not expected or not expected <= answered:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readables, writable, excp = select.select([sock, ], [], [],
+                                                      remaining)
+            if not readables:
+                # Timeout
+                break
+            for readable in readables:
+                data, sender_addr = readable.recvfrom(1024)
+                if data != b'0 1':
+                    response.append((data, sender_addr))
+                    answered.add(module_name(data))
+        sock.close()
     return response
 
 
 def sort(scan_result):
     "Returns list of ('iMACRT_name', 'ip_address')."
-    return [(data.decode('ascii').split('\x00')[0].split(' ')[-1], addr[0])
-            for data, addr in scan_result]
+    return [(module_name(data), addr[0]) for data, addr in scan_result]
+
+
+class Discovery(threading.Thread):
+    "Scan periodically in the background, the results are put in 'queue'."
+    def __init__(self, brd_addr='<broadcast>', period=SCAN_PERIOD,
+                 timeout=2):
+        super(Discovery, self).__init__(name='scan.Discovery', daemon=True)
+        self.brd_addr = brd_addr
+        self.period = period
+        self.timeout = timeout
+        self.queue = queue.Queue()  # lists of ('iMACRT_name', 'ip_address')
+        self.stopped = threading.Event()
+        self.start()
+
+    def run(self):
+        while not self.stopped.wait(self.period):
+            try:
+                self.queue.put(sort(scan(self.brd_addr, self.timeout)))
+            except OSError:
+                pass  # Network down, try again at the next period
+
+    def close(self):
+        "Stop the scans."
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,496 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""SQLite storage of the acquired data.
+
+Every sample is recorded in a Buffer, handed periodically as one batch to
+a Writer thread which groups the rows in transactions:
+
+>>> writer = Writer('data_storage.db', flush_interval=5, flush_size=1000)
+>>> buffer = Buffer()
+>>> buffer.add(time.time(), 'MMR3_01', 'Still', 1234.5, 1.2)
+>>> buffer.flush(writer)
+>>> writer.close()
+
+The database is used in WAL mode: the readers (graphs, analysis scripts)
+are not blocked by the writer.
+
+Schema: the 'channels' table gives an integer id to every
+(module_name, chan_name). The 'samples' table is clustered on
+(channel_id, t), with 't' the date in ms since the epoch: the samples of
+one channel are stored in contiguous pages. The 'rollup_60',
+'rollup_3600' and 'rollup_86400' tables hold the min, max, sum and count
+of R and T per channel and per bucket of 1 min, 1 h and 1 day. They are
+updated with each written batch, so the samples older than a retention
+age can be pruned. The schema version is kept in 'PRAGMA user_version':
+an older database, including one with the former 'data' table, is
+migrated in place when opened.
+
+The stored data of a channel are read, once the writer has created or
+migrated the schema, with:
+
+>>> conn = connect('data_storage.db', schema=False)
+>>> times, resistances, temperatures = read(conn, 'MMR3_01', 'Still',
+...                                         t_start, t_stop)
+
+or, from the coarsest table giving at least the 'resolution' (in s):
+
+>>> period, rows = query(conn, 'MMR3_01', 'Still', t_start, t_stop,
+...                      resolution=3600)
+
+The temperatures of a channel can be derived again from the stored
+resistances, after a correction of its conversion law:
+
+>>> reconvert(conn, 'MMR3_01_2_073_v2.2', 'Still', conversion.RuOx)
+"""
+
+
+import itertools
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import numpy as np
+from . import metrics
+
+
+SCHEMA_VERSION = 2
+ROLLUP_PERIODS = (60, 3600, 86400)  # in s
+SQL_CREATE_CHANNELS = """CREATE TABLE IF NOT EXISTS channels (
+id INTEGER PRIMARY KEY,
+module_name TEXT NOT NULL,
+chan_name TEXT NOT NULL,
+UNIQUE (module_name, chan_name)
+);"""
+SQL_CREATE_SAMPLES = """CREATE TABLE IF NOT EXISTS samples (
+channel_id INTEGER NOT NULL,
+t INTEGER NOT NULL,
+resistance REAL,
+temperature REAL,
+PRIMARY KEY (channel_id, t)
+) WITHOUT ROWID;"""
+SQL_SELECT_CHANNEL = """SELECT id FROM channels
+WHERE module_name = ? AND chan_name = ?;"""
+SQL_INSERT_CHANNEL = """INSERT INTO channels (module_name, chan_name)
+VALUES (?, ?);"""
+SQL_STORE = "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?);"
+SQL_SELECT = """SELECT t, resistance, temperature FROM samples
+WHERE channel_id = ? AND t >= ? AND t <= ? ORDER BY t;"""
+SQL_UPDATE_T = """UPDATE samples SET temperature = ?
+WHERE channel_id = ? AND t = ?;"""
+SQL_PRUNE = "DELETE FROM samples WHERE t < ?;"
+SQL_FIRST = "SELECT min(t) FROM samples WHERE channel_id = ?;"
+
+SQL_CREATE_ROLLUP = """CREATE TABLE IF NOT EXISTS rollup_{period} (
+channel_id INTEGER NOT NULL,
+bucket INTEGER NOT NULL,
+r_min REAL,
+r_max REAL,
+r_sum REAL NOT NULL,
+r_count INTEGER NOT NULL,
+t_min REAL,
+t_max REAL,
+t_sum REAL NOT NULL,
+t_count INTEGER NOT NULL,
+PRIMARY KEY (channel_id, bucket)
+) WITHOUT ROWID;"""
+# Merge the aggregates of a batch into the existing bucket
+SQL_MERGE_ROLLUP = """INSERT INTO rollup_{period}
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (channel_id, bucket) DO UPDATE SET
+r_min = min(coalesce(r_min, excluded.r_min),
+            coalesce(excluded.r_min, r_min)),
+r_max = max(coalesce(r_max, excluded.r_max),
+            coalesce(excluded.r_max, r_max)),
+r_sum = r_sum + excluded.r_sum,
+r_count = r_count + excluded.r_count,
+t_min = min(coalesce(t_min, excluded.t_min),
+            coalesce(excluded.t_min, t_min)),
+t_max = max(coalesce(t_max, excluded.t_max),
+            coalesce(excluded.t_max, t_max)),
+t_sum = t_sum + excluded.t_sum,
+t_count = t_count + excluded.t_count;"""
+# Compute again the buckets of a channel from the raw samples
+SQL_DELETE_ROLLUP = """DELETE FROM rollup_{period}
+WHERE channel_id = ? AND bucket >= ? AND bucket < ?;"""
+SQL_BUILD_ROLLUP = """INSERT OR REPLACE INTO rollup_{period}
+SELECT channel_id, t - t % {ms} AS bucket,
+min(resistance), max(resistance), total(resistance), count(resistance),
+min(temperature), max(temperature), total(temperature), count(temperature)
+FROM samples WHERE channel_id = ? AND t >= ? AND t < ?
+GROUP BY channel_id, bucket;"""
+# Compute again the coarser buckets from the finer ones
+SQL_CASCADE_ROLLUP = """INSERT OR REPLACE INTO rollup_{period}
+SELECT channel_id, bucket - bucket % {ms} AS coarse,
+min(r_min), max(r_max), total(r_sum), sum(r_count),
+min(t_min), max(t_max), total(t_sum), sum(t_count)
+FROM rollup_{finer} WHERE channel_id = ? AND bucket >= ? AND bucket < ?
+GROUP BY channel_id, coarse;"""
+SQL_SELECT_ROLLUP = """SELECT bucket, r_min, r_max, r_sum / r_count,
+t_min, t_max, t_sum / t_count FROM rollup_{period}
+WHERE channel_id = ? AND bucket >= ? AND bucket <= ? ORDER BY bucket;"""
+SQL_SELECT_RAW = """SELECT t, resistance, resistance, resistance,
+temperature, temperature, temperature FROM samples
+WHERE channel_id = ? AND t >= ? AND t <= ? ORDER BY t;"""
+
+# Version 0: one table, the names repeated on every row
+SQL_MIGRATE_0 = (
+    """INSERT OR IGNORE INTO channels (module_name, chan_name)
+    SELECT DISTINCT module_name, chan_name FROM data;""",
+    """INSERT OR REPLACE INTO samples
+    SELECT channels.id, CAST(round(data.datetime * 1000) AS INTEGER),
+    CASE WHEN typeof(data.resistance) = 'real' THEN data.resistance END,
+    CASE WHEN typeof(data.temperature) = 'real' THEN data.temperature END
+    FROM data JOIN channels USING (module_name, chan_name);""",
+    "DROP TABLE data;",
+)
+
+FLUSH_INTERVAL = 5  # in s
+FLUSH_SIZE = 1000  # rows
+PRUNE_INTERVAL = 3600  # in s
+T_MIN, T_MAX = -2 ** 63, 2 ** 63 - 1
+
+LOGGER = logging.getLogger(__name__)
+
+
+def to_ms(timestamp, default):
+    "Date in s to the stored integer ms, 'default' for None."
+    return default if timestamp is None else int(round(timestamp * 1000))
+
+
+def migrate_0(conn):
+    "Version 0 -> 1: normalize the 'data' table, if any."
+    conn.execute(SQL_CREATE_CHANNELS)
+    conn.execute(SQL_CREATE_SAMPLES)
+    legacy = conn.execute("""SELECT name FROM sqlite_master
+    WHERE type = 'table' AND name = 'data';""").fetchone()
+    if legacy:
+        for sql in SQL_MIGRATE_0:
+            conn.execute(sql)
+    return bool(legacy)
+
+
+def migrate_1(conn):
+    "Version 1 -> 2: add the rollup tables, built from the samples."
+    for period in ROLLUP_PERIODS:
+        conn.execute(SQL_CREATE_ROLLUP.format(period=period))
+    chan_ids = [row[0] for row in conn.execute('SELECT id FROM channels;')]
+    for chan_id in chan_ids:
+        build_rollups(conn, chan_id)
+    return False
+
+
+MIGRATIONS = (migrate_0, migrate_1)
+
+
+def schema_version(conn):
+    "Version of the schema of the database."
+    return conn.execute('PRAGMA user_version;').fetchone()[0]
+
+
+def migrate(conn):
+    "Bring the schema of the database to SCHEMA_VERSION."
+    version = schema_version(conn)
+    if version >= SCHEMA_VERSION:
+        return
+    existing = conn.execute('SELECT count(*) FROM sqlite_master;'
+                            ).fetchone()[0]
+    vacuum = False
+    with conn:
+        for step in MIGRATIONS[version:]:
+            if existing:
+                LOGGER.info('Migrating %s', step.__doc__)
+            vacuum |= step(conn)
+        conn.execute('PRAGMA user_version = {:d};'.format(SCHEMA_VERSION))
+    if vacuum:
+        conn.execute('VACUUM;')  # Give back the space of the old table
+
+
+def build_rollups(conn, chan_id, t_start=None, t_stop=None):
+    """Compute again from the samples the buckets of the channel 'chan_id'
+    overlapping the dates (in ms) 't_start' and 't_stop' (all by default).
+    The finest buckets are built from the samples, each coarser one from
+    the previous table. The buckets whose samples have been pruned are
+    kept as they are."""
+    first = conn.execute(SQL_FIRST, (chan_id, )).fetchone()[0]
+    if first is None:
+        return
+    finer = None
+    for period in ROLLUP_PERIODS:
+        ms = period * 1000
+        # prune() deletes whole days: the buckets from the one holding the
+        # first sample have all their samples
+        start = first - first % ms
+        if t_start is not None:
+            start = max(start, t_start - t_start % ms)
+        stop = T_MAX if t_stop is None else t_stop - t_stop % ms + ms
+        conn.execute(SQL_DELETE_ROLLUP.format(period=period),
+                     (chan_id, start, stop))
+        if finer is None:
+            sql = SQL_BUILD_ROLLUP.format(period=period, ms=ms)
+        else:
+            sql = SQL_CASCADE_ROLLUP.format(period=period, ms=ms,
+                                            finer=finer)
+        conn.execute(sql, (chan_id, start, stop))
+        finer = period
+
+
+def update_rollups(conn, rows):
+    "Merge the stored rows (channel_id, t, R, T) into the rollup tables."
+    for period in ROLLUP_PERIODS:
+        ms = period * 1000
+        buckets = {}
+        for chan_id, t, resistance, temperature in rows:
+            key = (chan_id, t - t % ms)
+            agg = buckets.get(key)
+            if agg is None:
+                agg = buckets[key] = [None, None, 0., 0, None, None, 0., 0]
+            for offset, value in ((0, resistance), (4, temperature)):
+                if value is None:
+                    continue
+                if agg[offset + 3]:
+                    agg[offset] = min(agg[offset], value)
+                    agg[offset + 1] = max(agg[offset + 1], value)
+                else:
+                    agg[offset] = agg[offset + 1] = value
+                agg[offset + 2] += value
+                agg[offset + 3] += 1
+        conn.executemany(SQL_MERGE_ROLLUP.format(period=period),
+                         [key + tuple(agg) for key, agg in buckets.items()])
+
+
+def prune(conn, max_age, now=None):
+    """Delete the samples older than 'max_age' seconds, by whole days. They
+    remain in the rollup tables. Returns the number of deleted samples."""
+    now = time.time() if now is None else now
+    day = ROLLUP_PERIODS[-1] * 1000
+    limit = to_ms(now - max_age, None)
+    with conn:
+        return conn.execute(SQL_PRUNE, (limit - limit % day, )).rowcount
+
+
+def query(conn, module_name, chan_name, t_start=None, t_stop=None,
+          resolution=0):
+    """Read the data of a channel between the dates 't_start' and 't_stop'
+    from the coarsest rollup table whose period doesn't exceed
+    'resolution' (in s), from the raw samples if none does. The data older
+    than the first raw sample left by prune() are then read from the
+    finest rollup table.
+    Returns (period, rows): 'period' is 0 for the raw samples only and
+    'rows' an array with the columns:
+    time (bucket start), R min, R max, R mean, T min, T max, T mean."""
+    period = max([p for p in ROLLUP_PERIODS if p <= resolution], default=0)
+    chan_id = channel_id(conn, module_name, chan_name)
+    rows = []
+    if chan_id is not None:
+        start = to_ms(t_start, T_MIN)
+        stop = to_ms(t_stop, T_MAX)
+        if period:
+            # Include the bucket holding 't_start'
+            if t_start is not None:
+                start -= start % (period * 1000)
+            rows = conn.execute(SQL_SELECT_ROLLUP.format(period=period),
+                                (chan_id, start, stop)).fetchall()
+        else:
+            first = conn.execute(SQL_FIRST, (chan_id, )).fetchone()[0]
+            if first is not None and start < first:
+                # Pruned: the buckets before the one of the first sample
+                period = ROLLUP_PERIODS[0]
+                ms = period * 1000
+                if t_start is not None:
+                    start -= start % ms
+                rows = conn.execute(SQL_SELECT_ROLLUP.format(period=period),
+                                    (chan_id, start,
+                                     min(stop, first - first % ms - 1))
+                                    ).fetchall()
+            rows += conn.execute(SQL_SELECT_RAW, (chan_id, start, stop)
+                                 ).fetchall()
+    rows = np.array(rows, dtype=float).reshape(-1, 7)
+    rows[:, 0] /= 1000
+    return period, rows
+
+
+def connect(filename, schema=True, **kwargs):
+    """Open the database 'filename', create or migrate its schema if
+    needed. Returns the connection. Only the writer may migrate: the
+    readers give 'schema=False' and check schema_version."""
+    conn = sqlite3.connect(filename, **kwargs)
+    if schema:
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('PRAGMA synchronous=NORMAL;')
+        migrate(conn)
+    return conn
+
+
+def channel_id(conn, module_name, chan_name, create=False):
+    """Returns the id of the channel, None if unknown.
+    If 'create', an unknown channel is added."""
+    row = conn.execute(SQL_SELECT_CHANNEL,
+                       (module_name, chan_name)).fetchone()
+    if row is not None:
+        return row[0]
+    if create:
+        return conn.execute(SQL_INSERT_CHANNEL,
+                            (module_name, chan_name)).lastrowid
+    return None
+
+
+def sqlize(value):
+    "Replaces NaN by None, stored as NULL."
+    return None if value != value else float(value)
+
+
+class Buffer:
+    "Rows acquired since the last flush to the Writer."
+    def __init__(self):
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, timestamp, module_name, chan_name, resistance,
+            temperature):
+        "Record one channel sample."
+        self.rows.append((timestamp, module_name, chan_name,
+                          sqlize(resistance), sqlize(temperature)))
+
+    def flush(self, writer):
+        "Hand all the recorded rows to 'writer' as one batch."
+        rows, self.rows = self.rows, []
+        if rows:
+            writer.write(rows)
+
+
+class Writer(threading.Thread):
+    "Thread writing the rows to the database by batches."
+    def __init__(self, filename, flush_interval=FLUSH_INTERVAL,
+                 flush_size=FLUSH_SIZE, retention=None):
+        """Initialisation:
+    arguments:
+    * filename: SQLite database
+    * flush_interval: commit the pending rows after at most this delay (s)
+    * flush_size: commit as soon as this number of rows is pending
+    * retention: prune the samples older than this age (s), None to keep
+      them all"""
+        super(Writer, self).__init__(name='storage.Writer', daemon=True)
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.retention = retention
+        self.queue = queue.Queue()
+        self.rows_written = 0
+        self.channel_ids = {}  # (module_name, chan_name) -> id
+        self.start()
+
+    def write(self, rows):
+        """Queue 'rows' for writing, returns immediately.
+    A row is (time, module_name, chan_name, resistance, temperature)."""
+        self.queue.put(list(rows))
+
+    def close(self):
+        "Write the pending rows and stop the thread."
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        conn = connect(self.filename)
+        pending = []
+        deadline = None
+        running = True
+        next_prune = time.monotonic()
+        while running:
+            if self.retention and time.monotonic() >= next_prune:
+                self.prune(conn)
+                next_prune = time.monotonic() + PRUNE_INTERVAL
+            wakeup = deadline
+            if self.retention:
+                wakeup = next_prune if wakeup is None else min(wakeup,
+                                                               next_prune)
+            timeout = None if wakeup is None else max(
+                wakeup - time.monotonic(), 0)
+            try:
+                rows = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                rows = []
+            if rows is None:
+                running = False
+            elif rows:
+                if not pending:
+                    deadline = time.monotonic() + self.flush_interval
+                pending.extend(rows)
+            if pending and (not running or len(pending) >= self.flush_size
+                            or time.monotonic() >= deadline):
+                self.commit(conn, pending)
+                pending = []
+                deadline = None
+        conn.close()
+
+    def commit(self, conn, rows):
+        "Write 'rows' in one transaction."
+        try:
+            with metrics.span('storage_commit_seconds'), conn:
+                stored = list(self.normalize(conn, rows))
+                conn.executemany(SQL_STORE, stored)
+                update_rollups(conn, stored)
+        except sqlite3.Error:
+            self.channel_ids = {}  # The new ids may have been rolled back
+            metrics.count('storage_errors_total')
+            LOGGER.exception('Cannot write %d rows to %s', len(rows),
+                             self.filename)
+        else:
+            self.rows_written += len(rows)
+            metrics.count('storage_rows_total', len(rows))
+
+    def prune(self, conn):
+        "Delete the samples older than the retention age."
+        try:
+            deleted = prune(conn, self.retention)
+        except sqlite3.Error:
+            LOGGER.exception('Cannot prune %s', self.filename)
+        else:
+            LOGGER.info('%d samples pruned from %s', deleted, self.filename)
+
+    def normalize(self, conn, rows):
+        "Yield the rows of 'rows' as stored: (channel_id, t, R, T)."
+        ids = self.channel_ids
+        for timestamp, module_name, chan_name, resistance, temperature \
+                in rows:
+            key = (module_name, chan_name)
+            if key not in ids:
+                ids[key] = channel_id(conn, module_name, chan_name, True)
+            yield (ids[key], to_ms(timestamp, None), resistance,
+                   temperature)
+
+
+def read(conn, module_name, chan_name, t_start=None, t_stop=None):
+    """Returns the arrays (times, resistances, temperatures) of a channel
+    stored between the dates 't_start' and 't_stop' (all by default).
+    The times are in s, the NULL values are NaN."""
+    chan_id = channel_id(conn, module_name, chan_name)
+    rows = [] if chan_id is None else conn.execute(SQL_SELECT, (
+        chan_id, to_ms(t_start, T_MIN), to_ms(t_stop, T_MAX))).fetchall()
+    data = np.array(rows, dtype=float).reshape(-1, 3)
+    return data[:, 0] / 1000, data[:, 1], data[:, 2]
+
+
+def reconvert(conn, module_name, chan_name, law, t_start=None, t_stop=None):
+    """Compute again with 'law' the temperatures of a channel stored
+    between the dates 't_start' and 't_stop' (all by default).
+    Returns the number of rows updated."""
+    chan_id = channel_id(conn, module_name, chan_name)
+    if chan_id is None:
+        return 0
+    rows = conn.execute(SQL_SELECT, (
+        chan_id, to_ms(t_start, T_MIN), to_ms(t_stop, T_MAX))).fetchall()
+    if not rows:
+        return 0
+    data = np.array(rows, dtype=float)  # None -> NaN
+    times = data[:, 0].astype(np.int64).tolist()
+    temperatures = law(data[:, 1])
+    temperatures = np.where(np.isfinite(temperatures), temperatures, None)
+    with conn:
+        # In the order of the primary key: the pages are visited once
+        conn.executemany(SQL_UPDATE_T, zip(
+            temperatures.tolist(), itertools.repeat(chan_id), times))
+        build_rollups(conn, chan_id, times[0], times[-1])
+    return len(times)
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Bounded columnar store of the live samples.
+
+>>> store = SampleStore(capacity=120960)
+>>> store.append(time.time(), {('MMR3_01', 'Still', 'R'): 1234.5})
+>>> times, values = store.window(('MMR3_01', 'Still', 'R'), t_start)
+
+All the columns share the same time column. A value missing in a sample is
+stored as NaN. Once 'capacity' samples are stored, the oldest one is
+dropped by each append.
+
+Every column is preallocated with twice the capacity and each value is
+written at two places, 'capacity' apart. The last samples are therefore
+always contiguous in memory: appends are O(1) and every read returns a
+view, never a copy.
+
+Each column also maintains a min/max decimation Pyramid, used to draw
+long time windows with a bounded number of points.
+"""
+
+
+import numpy as np
+from .decimate import Pyramid
+
+
+class SampleStore:
+    "Ring buffer of samples sharing a time column."
+    def __init__(self, capacity, lod_factor=4):
+        """'capacity' is the maximum number of samples kept, 'lod_factor'
+    the decimation factor between two levels of the pyramids (None to
+    disable them)."""
+        self.capacity = int(capacity)
+        self.lod_factor = lod_factor
+        self.count = 0  # Number of samples appended since the creation
+        self._time = np.full(2 * self.capacity, np.nan)
+        self._columns = {}
+        self._pyramids = {}
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def keys(self):
+        "Returns the keys of the columns."
+        return self._columns.keys()
+
+    def _bounds(self):
+        "Position of the oldest and after the newest samples in the buffers."
+        if self.count <= self.capacity:
+            return 0, self.count
+        start = self.count % self.capacity
+        return start, start + self.capacity
+
+    def append(self, timestamp, values):
+        "Append one sample: 'values' is a dict {key: value}."
+        pos = self.count % self.capacity
+        for key in values:
+            if key not in self._columns:
+                self._columns[key] = np.full(2 * self.capacity, np.nan)
+                if self.lod_factor:
+                    self._pyramids[key] = Pyramid(self.capacity,
+                                                  self.lod_factor)
+        self._time[pos] = self._time[pos + self.capacity] = timestamp
+        for key, column in self._columns.items():
+            value = values.get(key, np.nan)
+            column[pos] = column[pos + self.capacity] = value
+            if self.lod_factor:
+                self._pyramids[key].append(timestamp, value)
+        self.count += 1
+
+    def extend(self, timestamps, values):
+        """Append many samples at once: 'timestamps' is an array of dates,
+    'values' a dict {key: array of values}."""
+        timestamps = np.asarray(timestamps, dtype=float)
+        for key in values:
+            if key not in self._columns:
+                self._columns[key] = np.full(2 * self.capacity, np.nan)
+                if self.lod_factor:
+                    self._pyramids[key] = Pyramid(self.capacity,
+                                                  self.lod_factor)
+        # The samples beyond the capacity would be overwritten at once
+        skipped = max(len(timestamps) - self.capacity, 0)
+        pos = (self.count + np.arange(skipped, len(timestamps))) % \
+            self.capacity
+        self._time[pos] = self._time[pos + self.capacity] = \
+            timestamps[skipped:]
+        for key, column in self._columns.items():
+            if key in values:
+                block = np.asarray(values[key], dtype=float)
+            else:
+                block = np.full(len(timestamps), np.nan)
+            column[pos] = column[pos + self.capacity] = block[skipped:]
+            if self.lod_factor:
+                self._pyramids[key].extend(timestamps, block)
+        self.count += len(timestamps)
+
+    def times(self):
+        "View of the time column, oldest first."
+        start, stop = self._bounds()
+        return self._time[start:stop]
+
+    def column(self, key):
+        "View of the column 'key', oldest first."
+        start, stop = self._bounds()
+        return self._columns[key][start:stop]
+
+    def recompute(self, src, dst, func, t_start=None, t_stop=None):
+        """Set the column 'dst' to func(column 'src') for the samples taken
+    between the two dates. Ex, after the correction of a conversion law:
+
+    >>> store.recompute((module, chan, 'R'), (module, chan, 'T'), law)
+    """
+        times = self._time
+        selected = ~np.isnan(times)
+        if t_start is not None:
+            selected &= times >= t_start
+        if t_stop is not None:
+            selected &= times <= t_stop
+        column = self._columns[dst]
+        column[selected] = func(self._columns[src][selected])
+        if self.lod_factor:
+            # The buckets can't be updated in place: build them again
+            pyramid = self._pyramids[dst] = Pyramid(self.capacity,
+                                                    self.lod_factor)
+            for timestamp, value in zip(self.times().tolist(),
+                                        self.column(dst).tolist()):
+                pyramid.append(timestamp, value)
+
+    def pyramid(self, key):
+        "Decimation Pyramid of the column 'key'."
+        return self._pyramids[key]
+
+    def last(self, key):
+        "Most recent value of the column 'key'."
+        return self._columns[key][(self.count - 1) % self.capacity]
+
+    def last_time(self):
+        "Date of the most recent sample."
+        return self._time[(self.count - 1) % self.capacity]
+
+    def index(self, timestamp):
+        "Index in the views of the first sample taken at or after 'timestamp'."
+        return int(np.searchsorted(self.times(), timestamp, side='left'))
+
+    def window(self, key, t_start=None, t_stop=None):
+        "Views (times, values) of the column 'key' between the two dates."
+        times, values = self.times(), self.column(key)
+        start = 0 if t_start is None else self.index(t_start)
+        stop = len(times) if t_stop is None else int(
+            np.searchsorted(times, t_stop, side='right'))
+        return times[start:stop], values[start:stop]
+
+    def since(self, key, count):
+        """Views (times, values) of the samples of 'key' appended after the
+    store held 'count' samples."""
+        new = min(self.count - count, len(self))
+        times, values = self.times(), self.column(key)
+        return times[len(times) - new:], values[len(times) - new:]
+
+
+class Trace:
+    "Growable NaN free arrays (x, y) of a plotted curve."
+    def __init__(self, size=1024):
+        self._x = np.empty(size)
+        self._y = np.empty(size)
+        self.start = 0
+        self.stop = 0
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def x(self):
+        "View of the abscissas."
+        return self._x[self.start:self.stop]
+
+    @property
+    def y(self):
+        "View of the ordinates."
+        return self._y[self.start:self.stop]
+
+    def clear(self):
+        "Remove all the points."
+        self.start = self.stop = 0
+
+    def extend(self, x, y):
+        "Append the points (x, y), the NaN ordinates are skipped."
+        valid = ~np.isnan(y)
+        if not valid.all():
+            x, y = x[valid], y[valid]
+        size = len(self) + len(x)
+        if self.stop + len(x) > len(self._x):
+            # Move the points at the beginning, grow the buffers if needed
+            capacity = max(len(self._x), 2 * size)
+            for name in ('_x', '_y'):
+                old = getattr(self, name)
+                new = np.empty(capacity) if capacity > len(old) else old
+                new[:len(self)] = old[self.start:self.stop]
+                setattr(self, name, new)
+            self.start, self.stop = 0, size - len(x)
+        self._x[self.stop:self.stop + len(x)] = x
+        self._y[self.stop:self.stop + len(y)] = y
+        self.stop += len(x)
+
+    def trim(self, x_min):
+        "Remove the points before 'x_min', the abscissas being sorted."
+        self.start += int(np.searchsorted(self.x, x_min, side='left'))
@@ -0,0 +1,356 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Shared UDP transport for the iMACRT modules.
+
+Every iMACRT module answers to the port 12000 of the host. A single socket
+bound to that port is therefore owned by the process and shared by all the
+MACRTConn instances:
+
+>>> transport = get_transport()
+>>> transport.ask(('192.168.137.100', 12100), 'MMR3GET 0')
+
+The socket is served by an asyncio event loop running in a background
+thread. Replies are routed to the caller by their sender address, so many
+modules can have requests outstanding at the same time. The replies of one
+module are matched to its requests in the order they were sent: one batch
+of requests is in flight per module, and a batch missing a reply is
+discarded as a whole, the replies following the lost one being shifted.
+The module is then out of step: the replies to the discarded requests may
+still come. They are dropped as they arrive, and nothing is sent to the
+module until they all did or until it stayed quiet for the budget of the
+discarded request. A request which can't wait that long fails.
+
+The transport keeps a Link per module address:
+* the timeout given by the caller is a budget: each attempt waits for a
+  multiple of the 99th percentile of the recent round-trip times, then as
+  long again for the late replies before sending the batch again,
+* the GET commands, being idempotent, are sent again while the budget
+  allows it, at most RETRIES times,
+* after BREAKER_THRESHOLD failed requests, the circuit breaker opens: the
+  requests fail at once with CircuitOpen (a socket.timeout) and a probe
+  request is let through every BREAKER_COOLDOWN seconds. A reply to the
+  probe closes the breaker.
+"""
+
+
+import asyncio
+import collections
+import socket
+import threading
+import time
+from . import metrics
+
+
+LISTEN_PORT = 12000
+RTT_WINDOW = 64  # Round-trip times kept per module
+RTT_MIN_SAMPLES = 8  # before adapting the timeout
+RTT_PERCENTILE = 0.99
+TIMEOUT_FACTOR = 3  # Timeout of an attempt, in RTT percentile
+TIMEOUT_MIN = 0.05  # in s
+RETRIES = 2  # Extra attempts of the GET commands
+BREAKER_THRESHOLD = 3  # Consecutive failed requests opening the breaker
+BREAKER_COOLDOWN = 30  # in s, between two probes of an open breaker
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class CircuitOpen(socket.timeout):
+    "The module doesn't answer anymore, the request is not sent."
+
+
+def open_sock(port=LISTEN_PORT):
+    "Create and configure the communication socket."
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    except AttributeError:
+        # Some systems don't support SO_REUSEPORT
+        pass
+    sock.setblocking(False)
+    sock.bind(('', port))
+    return sock
+
+
+class MACRTProtocol(asyncio.DatagramProtocol):
+    "Datagram protocol routing the replies by sender address."
+    def __init__(self):
+        self.transport = None
+        self.pending = {}  # (ip, port) -> deque of futures
+        self.owed = collections.Counter()  # (ip, port) -> late replies
+        self.heard = {}  # (ip, port) -> loop time of the last datagram
+        self.waiters = {}  # (ip, port) -> futures of the next datagram
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for queue in self.pending.values():
+            for fut in queue:
+                if not fut.done():
+                    fut.set_exception(exc or ConnectionError('closed'))
+        self.pending = {}
+
+    def datagram_received(self, data, addr):
+        "Give the reply to the oldest request sent to 'addr'."
+        self.heard[addr] = asyncio.get_running_loop().time()
+        for waiter in self.waiters.pop(addr, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+        if self.owed[addr]:
+            self.owed[addr] -= 1  # Late reply to a discarded request
+            metrics.count('macrt_late_replies_total', module=addr[0])
+            return
+        queue = self.pending.get(addr)
+        if not queue:
+            metrics.count('macrt_unsolicited_total', module=addr[0])
+            return
+        fut = queue.popleft()
+        if not fut.done():
+            fut.set_result(data.decode('ascii'))
+
+    def request(self, addr, command):
+        "Send 'command' to 'addr' and return the future of the reply."
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(addr, collections.deque()).append(fut)
+        self.transport.sendto(command.encode('ascii'), addr)
+        return fut
+
+    def discard(self, addr, fut):
+        """Forget a request left without reply. Its reply, if any, will be
+    dropped when it arrives."""
+        queue = self.pending.get(addr)
+        if queue is not None:
+            try:
+                queue.remove(fut)
+            except ValueError:
+                return
+            self.owed[addr] += 1
+            self.heard[addr] = asyncio.get_running_loop().time()
+
+    async def resync(self, addr, quiet, deadline):
+        """Coroutine waiting for the late replies of 'addr' to arrive, or for
+    'addr' to stay quiet for 'quiet' seconds, when the replies are taken as
+    lost. Returns False if this doesn't happen before 'deadline'."""
+        loop = asyncio.get_running_loop()
+        while self.owed[addr]:
+            now = loop.time()
+            quiet_at = self.heard[addr] + quiet
+            if quiet_at <= now:
+                del self.owed[addr]  # Lost
+                break
+            if deadline <= now:
+                return False
+            waiter = loop.create_future()
+            self.waiters.setdefault(addr, []).append(waiter)
+            await asyncio.wait([waiter], timeout=min(quiet_at, deadline) - now)
+            waiter.cancel()
+        return True
+
+
+class Link:
+    "Round-trip times and circuit breaker of one module address."
+    def __init__(self):
+        self.rtts = collections.deque(maxlen=RTT_WINDOW)
+        self.lock = asyncio.Lock()  # Held while a batch is in flight
+        self.quiet = 0.  # in s, budget of the last batch sent
+        self.state = CLOSED
+        self.failures = 0  # Consecutive failed requests
+        self.opened = 0.  # Date of the opening of the breaker
+
+    def percentile(self, fraction=RTT_PERCENTILE):
+        "Percentile of the recent round-trip times, None if too few."
+        if len(self.rtts) < RTT_MIN_SAMPLES:
+            return None
+        rtts = sorted(self.rtts)
+        return rtts[int(fraction * (len(rtts) - 1))]
+
+    def timeout(self, budget):
+        "Timeout of one attempt, no longer than 'budget'."
+        rtt = self.percentile()
+        if rtt is None:
+            return budget
+        return min(max(TIMEOUT_FACTOR * rtt, TIMEOUT_MIN), budget)
+
+    def allow(self):
+        "Whether a request may be sent, let a probe through if it's time."
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and \
+                time.monotonic() >= self.opened + BREAKER_COOLDOWN:
+            self.state = HALF_OPEN
+            return True
+        return False
+
+    def success(self, rtt):
+        "Record a reply received after 'rtt' seconds."
+        self.rtts.append(rtt)
+        self.failures = 0
+        self.state = CLOSED
+
+    def failure(self):
+        "Record a request left without reply."
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= BREAKER_THRESHOLD:
+            self.state = OPEN
+            self.opened = time.monotonic()
+
+
+def command_type(command):
+    "'GET' or 'SET', the type of the command for the metrics."
+    return 'SET' if 'SET' in command.split(' ', 1)[0] else 'GET'
+
+
+class MACRTTransport:
+    "Process wide transport: one socket, one event loop thread."
+    def __init__(self, port=LISTEN_PORT):
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='MACRTTransport', daemon=True)
+        self.thread.start()
+        self.links = collections.defaultdict(Link)  # (ip, port) -> Link
+        self.protocol = self.call(self._open())
+
+    async def _open(self):
+        "Bind the socket on the transport loop."
+        _, protocol = await self.loop.create_datagram_endpoint(
+            MACRTProtocol, sock=open_sock(self.port))
+        return protocol
+
+    def call(self, coro):
+        "Run 'coro' on the transport loop and wait for its result."
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def send(self, addr, command):
+        "Send 'command' to 'addr', returns the future of the reply."
+        fut = self.protocol.request(addr, command)
+        sent = self.loop.time()
+        kind = command_type(command)
+        metrics.count('macrt_requests_total', module=addr[0], command=kind)
+
+        def received(fut):
+            "Record the round-trip time."
+            if not fut.cancelled() and fut.exception() is None:
+                rtt = self.loop.time() - sent
+                self.links[addr].success(rtt)
+                metrics.observe('macrt_rtt_seconds', rtt, module=addr[0],
+                                command=kind)
+        fut.add_done_callback(received)
+        return fut
+
+    async def request(self, addr, command, timeout):
+        """Coroutine sending 'command' to 'addr' and returning the reply.
+    Raises socket.timeout if no reply arrives within 'timeout' seconds."""
+        return (await self.request_many(addr, [command], timeout))[0]
+
+    def ask(self, addr, command, timeout):
+        "Send 'command' to 'addr', wait for the response and returns it."
+        return self.call(self.request(addr, command, timeout))
+
+    async def attempt(self, addr, commands, deadline, timeout):
+        """Coroutine sending all the 'commands' to 'addr' back to back and
+    returning the list of the replies, in order, or None if any is missing.
+    The requests left without reply after 'timeout' seconds stay queued for
+    as long again, until 'deadline' at most, absorbing their late replies.
+    The replies being matched to the requests in order, those of a batch
+    missing one are not reliable and are all discarded."""
+        link = self.links[addr]
+        futures = [self.send(addr, command) for command in commands]
+        try:
+            _, pending = await asyncio.wait(futures, timeout=timeout)
+            drain = min(timeout, deadline - self.loop.time())
+            if pending and drain > 0:
+                _, pending = await asyncio.wait(pending, timeout=drain)
+        except asyncio.CancelledError:
+            for fut in futures:
+                fut.cancel()
+                self.protocol.discard(addr, fut)
+            if link.state == HALF_OPEN:
+                link.state = OPEN  # Probe again later
+            raise
+        if not pending:
+            return [fut.result() for fut in futures]
+        for command, fut in zip(commands, futures):
+            if fut in pending:
+                fut.cancel()
+                self.protocol.discard(addr, fut)
+                metrics.count('macrt_timeouts_total', module=addr[0],
+                              command=command_type(command))
+        return None
+
+    async def request_each(self, addr, commands, timeout):
+        """Coroutine sending all the 'commands' to 'addr' back to back and
+    returning the list of the replies, in order. If a reply is missing, the
+    whole list is None: the replies received are not reliable. The GET
+    commands are sent again while 'timeout' allows it, once the late
+    replies of the discarded attempt are out of the way."""
+        if not commands:
+            return []
+        link = self.links[addr]
+        if not link.allow():
+            metrics.count('macrt_circuit_open_total', module=addr[0])
+            raise CircuitOpen('{}:{} is not answering'.format(*addr))
+        deadline = self.loop.time() + timeout
+        retried = all('GET' in command for command in commands)
+        # One batch at a time per module: the replies are matched in order
+        async with link.lock:
+            for attempt in range(RETRIES + 1):
+                # Late replies would be taken for those of this attempt
+                if not await self.protocol.resync(addr, link.quiet,
+                                                  deadline - TIMEOUT_MIN):
+                    metrics.count('macrt_desync_total', module=addr[0])
+                    if not attempt:
+                        if link.state == HALF_OPEN:
+                            link.state = OPEN  # Probe again later
+                        return [None for _ in commands]  # Nothing sent
+                    break
+                if attempt:
+                    metrics.count('macrt_retries_total', len(commands),
+                                  module=addr[0])
+                remaining = deadline - self.loop.time()
+                if retried and attempt < RETRIES:
+                    # Late replies are waited for as long again (drain)
+                    remaining = link.timeout(remaining / 2)
+                link.quiet = timeout  # Should the attempt be discarded
+                replies = await self.attempt(addr, commands, deadline,
+                                             remaining)
+                if replies is not None:
+                    return replies
+                if not retried or deadline - self.loop.time() < TIMEOUT_MIN:
+                    break
+        link.failure()
+        return [None for _ in commands]
+
+    async def request_many(self, addr, commands, timeout):
+        """Coroutine sending all the 'commands' to 'addr' back to back and
+    returning the list of the replies, in order. Raises socket.timeout if
+    any is left without reply."""
+        replies = await self.request_each(addr, commands, timeout)
+        if None in replies:
+            raise socket.timeout('No reply from {}:{} to {} commands'.format(
+                addr[0], addr[1], len(commands)))
+        return replies
+
+    def ask_many(self, addr, commands, timeout):
+        "Send all the 'commands' to 'addr' and returns the responses."
+        return self.call(self.request_many(addr, commands, timeout))
+
+    def close(self):
+        "Close the socket and stop the loop thread."
+        self.loop.call_soon_threadsafe(self.protocol.transport.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+_TRANSPORT = None
+_TRANSPORT_LOCK = threading.Lock()
+
+
+def get_transport():
+    "Returns the transport of the process, created on first use."
+    global _TRANSPORT
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT is None:
+            _TRANSPORT = MACRTTransport()
+        return _TRANSPORT
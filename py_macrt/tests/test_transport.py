@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Replies matched to their requests when some come late.
+
+$ python -m pytest tests
+"""
+
+import random
+import unittest
+from py_macrt.transport import get_transport
+from tools.simulator import Simulator
+
+
+STALL = 0.02  # Probability of delaying a reply
+STALL_TIME = 0.3  # in s
+ROUNDS = 300
+REGISTERS = 20
+
+
+class LateRepliesTest(unittest.TestCase):
+    "A late reply is never taken for the reply to a later request."
+    def setUp(self):
+        self.simulator = Simulator(1, latency=0.001, jitter=0.0005,
+                                   stall=STALL, kinds=('MMR3', ), seed=1)
+        self.device = self.simulator.devices[0]
+        self.device.stall_time = STALL_TIME
+        self.device.registers.update(
+            (register, float(register)) for register in range(REGISTERS))
+        self.addr = (self.device.addr, self.device.port)
+        self.transport = get_transport()
+        self.random = random.Random(1)
+
+    def tearDown(self):
+        self.simulator.close()
+
+    def test_delayed(self):
+        answered = 0
+        for _ in range(ROUNDS):
+            registers = self.random.sample(range(REGISTERS),
+                                           self.random.randint(1, 4))
+            replies = self.transport.call(self.transport.request_each(
+                self.addr, ['MMR3GET {}'.format(register)
+                            for register in registers], 1))
+            for register, reply in zip(registers, replies):
+                if reply is not None:
+                    self.assertEqual(float(reply), register)
+                    answered += 1
+        self.assertGreater(answered, ROUNDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Batch writes against a simulated module losing requests.
+
+$ python -m pytest tests
+"""
+
+import unittest
+from py_macrt.mmr3 import MMR3
+from tools.simulator import Simulator
+
+
+LOSS = 0.1  # Probability of dropping a request
+ROUNDS = 30
+AVG = {'chan1.avg': 7, 'chan2.avg': 18, 'chan3.avg': 29}  # -> register
+
+
+class WriteManyTest(unittest.TestCase):
+    "write_many reports per item what the module really received."
+    def setUp(self):
+        self.simulator = Simulator(1, latency=0.001, jitter=0.0005,
+                                   loss=LOSS, kinds=('MMR3', ), seed=1)
+        self.device = self.simulator.devices[0]
+        self.module = MMR3(self.device.addr)
+        self.module.port = self.device.port
+        self.module.timeout = 0.3
+
+    def tearDown(self):
+        self.simulator.close()
+
+    def check(self, verify):
+        "Write ROUNDS times and compare the results to the registers."
+        failed = 0
+        for k in range(ROUNDS):
+            values = {name: float(10 * k + i)
+                      for i, name in enumerate(AVG, 1)}
+            for register in AVG.values():
+                self.device.registers.pop(register, None)
+            results = self.module.write_many(values, verify=verify)
+            for name, written in results.items():
+                received = self.device.registers.get(AVG[name])
+                if written.ok:
+                    self.assertEqual(received, values[name], name)
+                else:
+                    failed += 1
+                if verify and written.value is not None:
+                    self.assertEqual(written.ok, received == values[name])
+        self.assertLess(failed, len(AVG) * ROUNDS)
+
+    def test_acknowledged(self):
+        self.check(verify=False)
+
+    def test_verified(self):
+        self.check(verify=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""End to end benchmark of the acquisition, against simulated modules.
+
+$ python -m tools.benchmark --modules 1 10 50 --latency 0.002 --loss 0.01
+
+For each number of modules, reports:
+* the polls and reads per second, polling back to back once the round-trip
+  times are learnt,
+* the percentiles of the round-trip times of the reads,
+* the cost of the work done by the main window callbacks, without Qt:
+  refresh (poll, convert and record one sample), store (hand the samples of
+  a save period to the writer, until committed) and plot (update of the
+  curves of every channel, incremental then full, as Graph.draw).
+"""
+
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+from py_macrt.decimate import Pyramid
+from py_macrt.logger import Logger
+from py_macrt.store import Trace
+from py_macrt.transport import RTT_MIN_SAMPLES
+from .simulator import Simulator, BROADCAST
+
+
+CONFIG = """[Main]
+brd_addr = {brd_addr}
+data_period = {period}
+save_period = {save_period}
+save_file = {save_file}
+flush_size = 1
+scan_period = 0
+{sections}"""
+PLOT_POINTS = 1000  # Width of the plot, in pixels
+
+
+def percentiles(values, fractions=(0.5, 0.9, 0.99)):
+    "Percentiles of 'values', NaN if empty."
+    if not values:
+        return [float('NaN') for _ in fractions]
+    values = sorted(values)
+    return [values[int(fraction * (len(values) - 1))]
+            for fraction in fractions]
+
+
+def timed(func, repeat):
+    "Median duration of 'func()' in ms."
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return 1e3 * statistics.median(durations)
+
+
+def throughput(logger, duration):
+    "Polls back to back during 'duration' s, returns (polls/s, reads/s)."
+    acquisition = logger.acquisition
+
+    async def run():
+        "Poll until the end of the duration."
+        for _ in range(RTT_MIN_SAMPLES):
+            await acquisition.poll()  # Learn the round-trip times first
+        count = 0
+        stop = time.monotonic() + duration
+        while time.monotonic() < stop:
+            await acquisition.poll()
+            count += 1
+        return count
+    polls = acquisition.transport.call(run())
+    reads = sum(len(module.channels) for module in logger.modules.values())
+    return polls / duration, polls * reads / duration
+
+
+def refresh(logger):
+    "Poll, convert and record one sample, as Main.refresh_cb."
+    logger.trigger()
+    logger.process(logger.acquisition.queue.get())
+
+
+def store(logger, n_samples):
+    "Record 'n_samples' samples and wait for their commit, as Main.store_cb."
+    names = list(logger.modules)
+    now = time.time()
+    for k in range(n_samples):
+        for name in names:
+            for i in range(3):
+                logger.buffer.add(now + k, name, logger.chan_name(name, i),
+                                  1000., 1.)
+    expected = logger.writer.rows_written + n_samples * 3 * len(names)
+    logger.flush()
+    while logger.writer.rows_written < expected:
+        time.sleep(1e-4)
+
+
+def fill(logger, n_samples):
+    "Fill the live buffer with 'n_samples' synthetic samples of every channel."
+    keys = [(name, logger.chan_name(name, i), conv)
+            for name in logger.modules for i in range(3)
+            for conv in ('R', 'T')]
+    start = time.time() - n_samples * logger.acquisition.period
+    for k in range(n_samples):
+        logger.data.append(start + k * logger.acquisition.period,
+                           {key: 1000. + k % 100 for key in keys})
+    return [key for key in keys if key[2] == 'T']
+
+
+def plot(data, keys, traces, count):
+    """Update the curves of 'keys' as Graph.draw, without drawing.
+    Returns the new count."""
+    prev = data.times()[0]
+    n_samples = len(data) - data.index(prev)
+    level_idx = data.pyramid(keys[0]).level_for(n_samples, PLOT_POINTS)
+    for key, trace in zip(keys, traces):
+        if level_idx is not None:
+            rows = data.pyramid(key).window(level_idx, prev)
+            x_data, y_data = Pyramid.envelope(rows)
+            valid = ~np.isnan(y_data)
+            x_data, y_data = x_data[valid], y_data[valid]
+            continue
+        if count:
+            trace.extend(*data.since(key, count))
+        else:
+            trace.clear()
+            trace.extend(*data.window(key, prev))
+        trace.trim(prev)
+    return data.count
+
+
+def run(n_modules, args):
+    "Benchmark with 'n_modules' simulated modules, returns a result row."
+    simulator = Simulator(n_modules, args.latency, args.jitter, args.loss,
+                          seed=0)
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file = os.path.join(tmp, 'config.ini')
+        with open(config_file, 'w') as config:
+            config.write(CONFIG.format(
+                brd_addr=BROADCAST, period=args.period,
+                save_period=args.save_period,
+                save_file=os.path.join(tmp, 'data.db'),
+                sections=''.join('[{}]\n'.format(device.name)
+                                 for device in simulator.devices)))
+        logger = Logger(config_file)
+        scan_ms = timed(logger.scan, 1)
+        if len(logger.modules) != n_modules:
+            print('{} modules found out of {}'.format(len(logger.modules),
+                                                      n_modules),
+                  file=sys.stderr)
+        transport = logger.acquisition.transport
+        transport.links.clear()
+        polls, reads = throughput(logger, args.duration)
+        rtts = [rtt for link in transport.links.values()
+                for rtt in link.rtts]
+        refresh_ms = timed(lambda: refresh(logger), args.repeat)
+        store_ms = timed(lambda: store(
+            logger, int(args.save_period // args.period)), args.repeat)
+        keys = fill(logger, args.samples)
+        traces = [Trace() for _ in keys]
+        plot_full_ms = timed(lambda: plot(logger.data, keys, traces, 0),
+                             args.repeat)
+        plot(logger.data, keys, traces, 0)
+        new_keys = keys + [key[:2] + ('R', ) for key in keys]
+
+        def plot_increment():
+            "One new sample, then the incremental update."
+            logger.data.append(logger.data.last_time() + args.period,
+                               {key: 1000. for key in new_keys})
+            plot(logger.data, keys, traces, logger.data.count - 1)
+        plot_inc_ms = timed(plot_increment, args.repeat)
+        logger.close()
+    simulator.close()
+    return ([n_modules, scan_ms, polls, reads] +
+            [1e3 * rtt for rtt in percentiles(rtts)] +
+            [refresh_ms, store_ms, plot_inc_ms, plot_full_ms])
+
+
+def main():
+    "Run the benchmark and print the results."
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--modules', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='mean reply delay of the modules in s')
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--loss', type=float, default=0.)
+    parser.add_argument('--duration', type=float, default=3,
+                        help='of the throughput measurement, in s')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--period', type=float, default=5,
+                        help='data_period of the simulated config, in s')
+    parser.add_argument('--save-period', type=float, default=30)
+    parser.add_argument('--samples', type=int, default=17280,
+                        help='live samples plotted (default: 1 day)')
+    args = parser.parse_args()
+    header = ('modules', 'scan ms', 'polls/s', 'reads/s', 'rtt p50 ms',
+              'p90 ms', 'p99 ms', 'refresh ms', 'store ms', 'plot+1 ms',
+              'plot ms')
+    print(' '.join('{:>10}'.format(title) for title in header))
+    for n_modules in args.modules:
+        row = run(n_modules, args)
+        print('{:>10d} '.format(row[0]) +
+              ' '.join('{:>10.3f}'.format(value) for value in row[1:]))
+
+
+if __name__ == '__main__':
+    main()
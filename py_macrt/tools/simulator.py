@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Simulated iMACRT modules, answering on the loopback interface.
+
+Each module listens on its own loopback address 127.0.1.k, on the port
+12000 + k, and answers the MMR3GET/MMR3SET or MRHTGET/MRHTSET commands.
+They all answer the scan ("0 1" sent to the port 8001 of the broadcast
+address 127.0.1.255):
+
+$ python -m tools.simulator --modules 10 --latency 0.005 --loss 0.01
+
+then set 'brd_addr = 127.0.1.255' in the [Main] section of config.ini.
+Linux routes the whole 127.0.0.0/8 to the loopback, other systems need
+the aliases, e.g. 'ifconfig lo0 alias 127.0.1.1' on macOS.
+
+From Python:
+
+>>> simulator = Simulator(10, latency=0.005, jitter=0.002, loss=0.01)
+>>> simulator.devices[0].registers[3] = 1234.5  # R of chan1 of a MMR3
+>>> simulator.close()
+"""
+
+
+import argparse
+import asyncio
+import random
+import socket
+import threading
+
+
+SUBNET = '127.0.1.'
+BROADCAST = SUBNET + '255'
+SCAN_PORT = 8001
+BASE_PORT = 12000
+REPLY_SPACING = 1e-6  # in s, between two replies of a device
+
+
+def open_sock(addr):
+    "UDP socket bound to 'addr', shared with the other listeners."
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    except AttributeError:
+        # Some systems don't support SO_REUSEPORT
+        pass
+    sock.setblocking(False)
+    sock.bind(addr)
+    return sock
+
+
+class Device(asyncio.DatagramProtocol):
+    "One simulated module, replying in the order of the requests."
+    def __init__(self, name, index, latency=0.001, jitter=0., loss=0.,
+                 stall=0., stall_time=0.3, registers=None, seed=None):
+        """Initialisation:
+    arguments:
+    * name: module name, 'MMR3...' or 'MRHT...'
+    * index: last byte of the address of the module
+    * latency, jitter: mean and standard deviation of the reply delay, in s
+    * loss: probability of dropping a request
+    * stall, stall_time: probability of holding a reply, and the following
+      ones, for 'stall_time' more seconds
+    * registers: dict {register index: value}, see 'value'"""
+        self.name = name
+        self.index = index
+        self.addr = SUBNET + str(index)
+        self.port = BASE_PORT + index
+        self.prefix = name[:4]
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.stall = stall
+        self.stall_time = stall_time
+        self.registers = dict(registers or {})
+        self.random = random.Random(seed)
+        self.transport = None
+        self.last_reply = 0.  # Loop time of the last reply scheduled
+        self.requests = 0
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def value(self, register):
+        "Value of a register never set: a noisy resistance."
+        return 1000. * (1 + register % 7) * (1 + 1e-3 * self.random.random())
+
+    def answer(self, command):
+        "Reply to 'command', None if not understood."
+        try:
+            verb, *args = command.split()
+            if verb == self.prefix + 'GET':
+                register = int(args[0])
+                return str(self.registers.get(register,
+                                              self.value(register)))
+            if verb == self.prefix + 'SET':
+                self.registers[int(args[0])] = float(args[1])
+                return args[1]
+        except (IndexError, ValueError):
+            pass
+        return None
+
+    def datagram_received(self, data, addr):
+        self.requests += 1
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        reply = self.answer(data.decode('ascii', 'replace'))
+        if reply is None:
+            return
+        loop = asyncio.get_running_loop()
+        delay = max(self.random.gauss(self.latency, self.jitter), 0)
+        if self.random.random() < self.stall:
+            delay += self.stall_time
+        # The module answers one request after the other. The loop doesn't
+        # keep the order of the callbacks due at the same time: the replies
+        # are scheduled at strictly increasing times.
+        self.last_reply = max(loop.time() + delay,
+                              self.last_reply + REPLY_SPACING)
+        loop.call_at(self.last_reply, self.transport.sendto,
+                     reply.encode('ascii'), addr)
+
+
+class Announcer(asyncio.DatagramProtocol):
+    "Answer the scans on behalf of all the devices."
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if data != b'0 1':
+            return
+        for device, sock in self.simulator.scan_socks:
+            sock.sendto('0 1 {}\x00'.format(device.name).encode('ascii'),
+                        addr)
+
+
+class Simulator:
+    "Simulated modules, served by an event loop in a background thread."
+    def __init__(self, n_modules=1, latency=0.001, jitter=0., loss=0.,
+                 stall=0., kinds=('MMR3', 'MRHT'), seed=None):
+        """Initialisation:
+    arguments:
+    * n_modules: number of modules, at 127.0.1.1, 127.0.1.2...
+    * latency, jitter, loss, stall: see Device
+    * kinds: the modules alternate these types"""
+        self.devices = [
+            Device('{}_{:02d}_sim'.format(kinds[k % len(kinds)], k + 1),
+                   k + 1, latency, jitter, loss, stall,
+                   seed=None if seed is None else seed + k)
+            for k in range(n_modules)]
+        self.scan_socks = [(device, open_sock((device.addr, SCAN_PORT)))
+                           for device in self.devices]
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='Simulator', daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._open(), self.loop).result()
+
+    async def _open(self):
+        "Bind the sockets of the devices on the loop."
+        self.endpoints = []
+        for device in self.devices:
+            transport, _ = await self.loop.create_datagram_endpoint(
+                lambda device=device: device,
+                sock=open_sock((device.addr, device.port)))
+            self.endpoints.append(transport)
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: Announcer(self), sock=open_sock((BROADCAST, SCAN_PORT)))
+        self.endpoints.append(transport)
+
+    async def _close(self):
+        "Close the sockets of the devices on the loop."
+        for transport in self.endpoints:
+            transport.close()
+        await asyncio.sleep(0)  # Let the transports close their sockets
+
+    def close(self):
+        """Close the sockets and stop the loop. A socket left open would
+    take its share of the datagrams of the next Simulator (SO_REUSEPORT)."""
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        for _, sock in self.scan_socks:
+            sock.close()
+
+
+def main():
+    "Run the simulator until interrupted."
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--modules', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='mean reply delay in s')
+    parser.add_argument('--jitter', type=float, default=0.,
+                        help='standard deviation of the reply delay in s')
+    parser.add_argument('--loss', type=float, default=0.,
+                        help='probability of dropping a request')
+    parser.add_argument('--stall', type=float, default=0.,
+                        help='probability of delaying a reply by 0.3 s')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    simulator = Simulator(args.modules, args.latency, args.jitter, args.loss,
+                          args.stall, seed=args.seed)
+    for device in simulator.devices:
+        print('{} at {}:{}'.format(device.name, device.addr, device.port))
+    try:
+        simulator.thread.join()
+    except KeyboardInterrupt:
+        simulator.close()
+
+
+if __name__ == '__main__':
+    main()
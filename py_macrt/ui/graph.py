@@ -6,7 +6,10 @@ from pyqtgraph import QtCore, QtGui
 import pyqtgraph as pg
 from tools.dateaxis import DateAxis
 from .graph_ui import Ui_Graph_Widget
-from math import isnan
+from py_macrt import metrics
+from py_macrt.decimate import Pyramid
+from py_macrt.store import Trace
+import numpy as np
 
 
 DURATION = [
@@ -25,6 +28,8 @@ DURATION = [
 
 class Graph(QtGui.QWidget, Ui_Graph_Widget):
     "Graph class"
+    history_loaded = QtCore.pyqtSignal()
+
     def __init__(self, parent, channels):
         "Requires the parents and the selected channels."
         QtGui.QWidget.__init__(self, parent, QtCore.Qt.Window)
@@ -35,14 +40,19 @@ class Graph(QtGui.QWidget, Ui_Graph_Widget):
         self.data = self.parent.data
         self.channels = channels
         self.conv = 'R'
-
-        self.timer = QtCore.QTimer()
+        self.view = None  # (duration index, conv) currently plotted
+        self.count = 0  # Number of samples in the store at the last refresh
+        self.traces = {chan_name: Trace()
+                       for module_name, chan_name in self.channels}
+        self.history = self.parent.history
+        self.live = self.parent.live
 
         # Connect signals
-        self.timer.timeout.connect(self.update_plot)
         self.cB_resistance.stateChanged.connect(self.resistance_temperature)
         self.pBtn_Close.clicked.connect(self.close)
         self.cB_Time.currentIndexChanged.connect(self.update_plot)
+        self.PlotWidget.sigXRangeChanged.connect(self.update_history)
+        self.history_loaded.connect(self.update_history)
 
         # Prepare the plot widget
         time_axis = DateAxis(orientation='bottom')
@@ -55,23 +65,119 @@ class Graph(QtGui.QWidget, Ui_Graph_Widget):
             chan_name: self.PlotWidget.plot(pen=c, name=chan_name,
                                             symbolBrush=c, symbolPen='w')
             for (module_name, chan_name), c in zip(self.channels, colors)}
+        # Stored data, older than the live ones
+        self.history_plots = {
+            chan_name: self.PlotWidget.plot(pen=c)
+            for (module_name, chan_name), c in zip(self.channels, colors)}
         self.PlotWidget.setLabel('bottom', 'Time', units='s')
-        self.timer.start(5 * 1000)  # in ms
+        self.subscribe()
         self.update_plot()
 
-    def update_plot(self):
-        "Refresh the data plotted."
-        last = self.data['time'][-1]
-        if int(self.cB_Time.currentIndex()):
-            prev = last - DURATION[int(self.cB_Time.currentIndex())]
-        else:
-            prev = 0  # All data
+    def subscribe(self):
+        "Follow the channels displayed in the live data model."
+        self.live.subscribe(self.samples_cb,
+                            [(module_name, chan_name, self.conv)
+                             for module_name, chan_name in self.channels])
+
+    def closeEvent(self, event):
+        self.live.unsubscribe(self.samples_cb)
+        QtGui.QWidget.closeEvent(self, event)
+
+    def samples_cb(self, start, deltas):
+        "Called by the live data model with the new samples."
+        if start != self.count:
+            deltas = None  # Not following the last refresh: plot everything
+        self.draw(deltas)
+
+    def update_plot(self, *args):
+        "Plot again the whole displayed duration."
+        self.draw(None)
+
+    def draw(self, deltas):
+        """Refresh the data plotted.
+    'deltas' is a dict {key: (times, values)} of the samples appended since
+    the last refresh: they are added to the curves, unless the displayed
+    duration or data set changed. When the duration holds more samples than
+    the plot has pixels, the curves are drawn from the min/max buckets of
+    the decimation pyramids."""
+        with metrics.span('ui_plot_seconds'):
+            if not self.data.count:
+                return
+            duration_idx = int(self.cB_Time.currentIndex())
+            prev = self.data.times()[0]  # Oldest data available
+            if duration_idx:
+                prev = max(prev,
+                           self.data.last_time() - DURATION[duration_idx])
+            n_samples = len(self.data) - self.data.index(prev)
+            n_points = max(self.PlotWidget.width(), 1)
+            keys = [(chan_name, (module_name, chan_name, self.conv))
+                    for module_name, chan_name in self.channels
+                    if (module_name, chan_name, self.conv) in self.data]
+            level_idx = None
+            if keys and self.data.lod_factor:
+                level_idx = self.data.pyramid(keys[0][1]).level_for(
+                    n_samples, n_points)
+            if (duration_idx, self.conv, level_idx) != self.view:
+                self.view = (duration_idx, self.conv, level_idx)
+                deltas = None
+            for chan_name, key in keys:
+                if level_idx is not None:
+                    rows = self.data.pyramid(key).window(level_idx, prev)
+                    x_data, y_data = Pyramid.envelope(rows)
+                    valid = ~np.isnan(y_data)
+                    self.plots[chan_name].setData(x=x_data[valid],
+                                                  y=y_data[valid])
+                    continue
+                trace = self.traces[chan_name]
+                if deltas is not None and key in deltas:
+                    trace.extend(*deltas[key])
+                else:
+                    trace.clear()
+                    trace.extend(*self.data.window(key, prev))
+                trace.trim(prev)
+                self.plots[chan_name].setData(x=trace.x, y=trace.y)
+            self.count = self.data.count
+
+    def update_history(self, *args):
+        """Plot the stored data older than the live ones, in the visible
+    range. The missing chunks are requested from the History thread, the
+    plot is updated again when they are loaded."""
+        if self.history is None:
+            return  # Not stored in a database
+        x_min, x_max = self.PlotWidget.viewRange()[0]
+        x_min = max(x_min, 0)
+        live_start = self.data.times()[0] if self.data.count else x_max
+        x_max = min(x_max, live_start)
+        resolution = (x_max - x_min) / max(self.PlotWidget.width(), 1)
+        column = 1 if self.conv == 'R' else 4  # min, max, mean columns
         for module_name, chan_name in self.channels:
-            y_data = self.data[module_name][chan_name][self.conv]
-            time_data = [[t, y] for t, y in zip(self.data['time'], y_data)
-                         if t >= prev and not isnan(y)]
-            time, data = [list(row) for row in zip(*time_data)]
-            self.plots[chan_name].setData(x=time, y=data)
+            if x_min >= x_max:
+                self.history_plots[chan_name].setData(x=[], y=[])
+                continue
+            chunks = []
+            keys = self.history.keys(module_name, chan_name, x_min, x_max,
+                                     resolution)
+            for key in keys:
+                rows = self.history.get(key)
+                if rows is None:
+                    self.history.request(key, self.history_cb)
+                else:
+                    chunks.append(rows)
+            rows = np.concatenate(chunks) if chunks else np.empty((0, 7))
+            rows = rows[rows[:, 0] < live_start]
+            if keys[0][2]:
+                # Rollup buckets: draw their min/max envelope
+                x_data = np.repeat(rows[:, 0], 2)
+                y_data = rows[:, column:column + 2].ravel()
+            else:
+                x_data, y_data = rows[:, 0], rows[:, column + 2]
+            valid = ~np.isnan(y_data)
+            self.history_plots[chan_name].setData(x=x_data[valid],
+                                                  y=y_data[valid])
+
+    def history_cb(self, key, rows):
+        "Called by the History thread when a chunk is loaded."
+        self.history_loaded.emit()
 
     def resistance_temperature(self):
         "Select the 'resistance' or the 'temperature' data set."
@@ -81,4 +187,6 @@ class Graph(QtGui.QWidget, Ui_Graph_Widget):
         else:
             self.conv = 'R'
             self.cB_resistance.setText("Resistance")
+        self.subscribe()
         self.update_plot()
+        self.update_history()
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Live data model shared by the graph windows.
+
+The main window notifies the model when samples are appended to the live
+store. The model then tells the windows subscribed to a channel which
+samples are new, at most once per DISPLAY_PERIOD:
+
+>>> live = LiveData(store)
+>>> live.subscribe(graph.samples_cb, [('MMR3_01', 'Still', 'R')])
+>>> store.append(time.time(), values)
+>>> live.notify()
+
+The callback receives (start, deltas): 'deltas' is a dict {key: (times,
+values)} of views of the samples appended since the store held 'start'
+samples. The views are taken once for all the windows. 'deltas' is None
+when some of these samples were already dropped from the store: the
+window reads it again.
+"""
+
+from PyQt4 import QtCore
+
+
+DISPLAY_PERIOD = 1000 // 60  # in ms, at most one notification per frame
+
+
+class LiveData(QtCore.QObject):
+    "Notify the subscribed windows of the samples appended to a store."
+    def __init__(self, data, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.data = data
+        self.count = data.count  # Samples already announced
+        self.subscribers = {}  # callback -> keys
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(DISPLAY_PERIOD)
+        self.timer.timeout.connect(self.publish)
+
+    def subscribe(self, callback, keys):
+        "Call 'callback(start, deltas)' when the columns 'keys' grow."
+        self.subscribers[callback] = set(keys)
+
+    def unsubscribe(self, callback):
+        "Stop calling 'callback'."
+        self.subscribers.pop(callback, None)
+
+    def notify(self):
+        "Announce the new samples, if any, once the display period elapsed."
+        if self.data.count != self.count and not self.timer.isActive():
+            self.timer.start()
+
+    def publish(self):
+        "Give the samples appended since the last call to the subscribers."
+        start, self.count = self.count, self.data.count
+        if start == self.count:
+            return
+        overrun = self.count - start > len(self.data)
+        deltas = {}
+        for callback, keys in list(self.subscribers.items()):
+            if overrun:
+                callback(start, None)
+                continue
+            for key in keys:
+                if key not in deltas and key in self.data:
+                    deltas[key] = self.data.since(key, start)
+            callback(start, {key: deltas[key] for key in keys
+                             if key in deltas})
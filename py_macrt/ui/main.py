@@ -3,21 +3,16 @@
 
 """Main window class."""
 
-from configparser import ConfigParser
-import sqlite3
-import time
 from PyQt4 import QtCore, QtGui
+from py_macrt import metrics
+from py_macrt.history import History
+from py_macrt.logger import Logger
+from .live import LiveData
 from .main_ui import Ui_MainWindow
 
 
-SQL_CREATE_TABLE = """CREATE TABLE IF NOT EXISTS data (
-datetime INTEGER,
-module_name TEXT,
-chan_name TEXT,
-resistance REAL,
-temperature REAL
-);"""
-SQL_STORE = "INSERT INTO data VALUES (?, ?, ?, ?, ?);"
+CONSUME_PERIOD = 200  # in ms
+METRICS_PERIOD = 1000  # in ms, refresh of the metrics panel
 
 
 class Main(QtGui.QMainWindow, Ui_MainWindow):
@@ -29,6 +24,7 @@ class Main(QtGui.QMainWindow, Ui_MainWindow):
 
         self.data_timer = QtCore.QTimer()
         self.store_timer = QtCore.QTimer()
+        self.metrics_timer = QtCore.QTimer()
         self.tw_root = self.treeWidget.invisibleRootItem()
 
         # Connect signals
@@ -36,85 +32,100 @@ class Main(QtGui.QMainWindow, Ui_MainWindow):
         self.pBtn_Scan.clicked.connect(self.scan_cb)
         self.pBtn_Refresh.clicked.connect(self.refresh_cb)
         self.pBtn_Graph.clicked.connect(self.open_graph_window)
-        self.data_timer.timeout.connect(self.refresh_cb)
+        self.data_timer.timeout.connect(self.consume_cb)
         self.store_timer.timeout.connect(self.store_cb)
+        self.metrics_timer.timeout.connect(self.metrics_cb)
+
+        # Metrics panel
+        self.metrics_view = QtGui.QPlainTextEdit()
+        self.metrics_view.setReadOnly(True)
+        self.metrics_view.setLineWrapMode(QtGui.QPlainTextEdit.NoWrap)
+        self.metrics_dock = QtGui.QDockWidget('Metrics', self)
+        self.metrics_dock.setWidget(self.metrics_view)
+        self.addDockWidget(QtCore.Qt.BottomDockWidgetArea, self.metrics_dock)
+        self.menuQuitter.insertAction(self.actionQuit,
+                                      self.metrics_dock.toggleViewAction())
+        self.menuQuitter.insertAction(
+            self.actionQuit, QtGui.QAction('Export metrics...', self,
+                                           triggered=self.export_metrics_cb))
 
-        self.data = {'time': [], }
         self.graphs = []
         self.modules = {}
 
-        self.config = ConfigParser()
-        try:
-            self.config.read(self.config_file)
-        except AttributeError:
-            pass
-
+        self.logger = Logger(self.config_file)
+        self.data = self.logger.data
+        self.live = LiveData(self.data, self)
+        # Channel names shown: from the plan, or from the source
+        self.plan = self.logger.plan
+        self.remote_channels = {}
+        self.acquisition = self.logger.acquisition
+        self.history = None
+        if self.logger.storage is not None:
+            self.history = History(self.logger.storage)
         self.scan_cb()
-        if self.modules:
-            self.refresh_cb()
+        self.logger.start()
+        self.data_timer.start(CONSUME_PERIOD)
+        self.store_timer.start(self.logger.save_period * 1000)
+        self.metrics_timer.start(METRICS_PERIOD)
 
-        storage = self.config['Main'].get('save_file', 'data_storage.db')
-        self.conn = sqlite3.connect(storage)
-        self.cursor = self.conn.cursor()
-        self.cursor.execute(SQL_CREATE_TABLE)
-        self.conn.commit()
-        store_period = int(self.config['Main'].get('save_period', 30))
-        self.store_timer.start(store_period * 1000)
+    @property
+    def config(self):
+        "Current config, reloaded by the logger when the file changes."
+        return self.logger.config
 
     def quit_cb(self, *args, **kwargs):
-        "Quit the app. Save the config."
+        "Quit the app. Save the config and the acquired data."
         self.config.write(open(self.config_file, 'w'))
-        try:
-            self.conn.close()
-        except:
-            pass
+        self.logger.close()
+        if self.history is not None:
+            self.history.close()
         QtGui.QApplication.quit()
 
     def scan_cb(self, *args, **kwargs):
         "Scan the subnet for active iMACRT modules."
-        from py_macrt import scan
-        self.modules = {}
-        brd_addr = self.config['Main'].get('brd_addr', '255.255.255.255')
-        for name, addr in scan.sort(scan.scan(brd_addr)):
-            if name.startswith('MMR3'):
-                from py_macrt.mmr3 import MMR3
-                self.modules[name] = {'obj': MMR3(addr)}
-            if name.startswith('MRHT'):
-                from py_macrt.mmr3 import MRHT
-                self.modules[name] = {'obj': MRHT(addr)}
-        period = int(self.config['Main'].get('data_period', 5))
-        self.data_timer.start(period * 1000)  # in ms
-        self.add_module()
+        self.logger.scan()
+        self.sync_modules()
 
     def refresh_cb(self, *args, **kwargs):
-        "Refresh values for every iMACRT modules."
-        import conversion
-        self.data['time'].append(time.time())
+        "Ask for an immediate reading of every iMACRT modules."
+        self.logger.trigger()  # Timed by acquisition_poll_seconds
+
+    def consume_cb(self):
+        "Display the samples delivered by the acquisition engine."
+        with metrics.span('ui_consume_seconds'):
+            results = self.logger.consume()
+            self.live.notify()
+            if self.logger.plan is not self.plan or \
+                    self.logger.remote_channels != self.remote_channels:
+                self.rename_channels()  # Config file reloaded, or source's
+            if self.logger.source:
+                message = '' if self.logger.subscriber is not None else \
+                    'Disconnected from {}, reconnecting...'.format(
+                        self.logger.source)
+                if self.statusbar.currentMessage() != message:
+                    self.statusbar.showMessage(message)
+            if set(self.modules) != set(self.logger.modules):
+                self.sync_modules()  # Changed by a background scan
+            for name, i, resistance, conv_str in results:
+                chan_item = self.modules[name]['chan_item'][i]
+                chan_item.setText(1, str(resistance))
+                chan_item.setText(2, str(conv_str))
+
+    def sync_modules(self):
+        "Follow the modules of the logger, keeping the known tree items."
+        for name in set(self.modules) - set(self.logger.modules):
+            self.tw_root.removeChild(self.modules.pop(name)['treewidget'])
+        for name, obj in self.logger.modules.items():
+            self.modules.setdefault(name, {})['obj'] = obj
+        self.add_module()
+
+    def rename_channels(self):
+        "Show the current channel names of the logger."
+        self.plan = self.logger.plan
+        self.remote_channels = dict(self.logger.remote_channels)
         for name, module in self.modules.items():
-            for i in range(3):
-                if name not in self.data:
-                    self.data[name] = {}
-                chan_name = self.config[name].get('Chan' + str(i),
-                                                  'Chan' + str(i))
-                if chan_name not in self.data[name]:
-                    self.data[name][chan_name] = {'R': [], 'T': []}
-                resistance = getattr(module['obj'], 'chan' + str(i + 1)).R
-                module['chan_item'][i].setText(1, str(resistance))
-                try:
-                    law_name = self.config[name]['Law' + str(i)]
-                    law = getattr(conversion, law_name)
-                    converted = law(resistance)
-                    formatter = self.config['Main'].get('formatter', '{:.4f}')
-                    conv_str = formatter.format(converted)
-                except (KeyError, AttributeError):
-                    converted = float('NaN')
-                    conv_str = "Wrong or missing configuration file."
-                except ZeroDivisionError:
-                    converted = float('NaN')
-                    conv_str = 'ZeroDivision with law {}.'.format(law_name)
-                module['chan_item'][i].setText(2, str(conv_str))
-                self.data[name][chan_name]['R'].append(resistance)
-                self.data[name][chan_name]['T'].append(converted)
+            for i, chan_item in enumerate(module.get('chan_item', [])):
+                chan_item.setText(0, self.logger.chan_name(name, i))
 
     def add_module(self):
         "Actualized the TreeWidget with the active iMACRT modules."
@@ -123,10 +134,7 @@ class Main(QtGui.QMainWindow, Ui_MainWindow):
                 continue
             _tw = QtGui.QTreeWidgetItem(
                 self.tw_root, [name, ])
-            if self.config.has_section(name):
-                module_conf = self.config[name]
-                chan_names = [module_conf.get(
-                    'Chan' + str(i), 'Chan' + str(i + 1)) for i in range(3)]
+            chan_names = [self.logger.chan_name(name, i) for i in range(3)]
 
             module['chan_item'] = [
                 QtGui.QTreeWidgetItem(_tw, [chan_name, "", ""])
@@ -147,23 +155,18 @@ class Main(QtGui.QMainWindow, Ui_MainWindow):
         self.treeWidget.clearSelection()
 
     def store_cb(self):
-        "Store periodically the data into a SQLite database."
-        def sqlize(value):
-            "Replaces NaN by NULL."
-            from math import isnan
-            return isnan(value) and 'NULL' or value
-
-        to_store = []
-        for module_name, mod_data in self.data.items():
-            if module_name == 'time':
-                continue
-            for chan_name, values in mod_data.items():
-            # store 'time', 'module', 'chan_name', 'R', 'T'
-                to_store.append((
-                    self.data['time'][-1],
-                    module_name,
-                    chan_name,
-                    sqlize(values['R'][-1]),
-                    sqlize(values['T'][-1])))
-        self.cursor.executemany(SQL_STORE, to_store)
-        self.conn.commit()
+        "Send periodically the acquired data to the storage."
+        with metrics.span('ui_store_seconds'):
+            self.logger.flush()
+
+    def metrics_cb(self):
+        "Refresh the metrics panel, if visible."
+        if self.metrics_dock.isVisible():
+            self.metrics_view.setPlainText(metrics.METRICS.summary())
+
+    def export_metrics_cb(self, *args, **kwargs):
+        "Save a snapshot of the metrics in a text file."
+        filename = QtGui.QFileDialog.getSaveFileName(
+            self, 'Export metrics', 'metrics.txt')
+        if filename:
+            self.logger.export_metrics(str(filename))